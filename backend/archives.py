@@ -0,0 +1,235 @@
+import mimetypes
+import posixpath
+import tarfile
+import time
+import zipfile
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import storage
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+# Metadata files that archivers add and nobody wants in a course folder
+IGNORED_PREFIXES = ("__MACOSX/",)
+IGNORED_NAMES = (".DS_Store", "Thumbs.db")
+
+
+class InvalidArchive(Exception):
+    pass
+
+
+@dataclass
+class SpooledEntry:
+    folder: Tuple[str, ...]   # Folder names below the upload target
+    filename: str
+    content_type: Optional[str]
+    spool_path: str
+    size: int
+    content_hash: str
+
+
+def is_archive(filename):
+    return (filename or "").lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def split_member_path(name):
+    """Folder parts and file name of an archive member, None if it is unsafe or ignored."""
+    name = name.replace("\\", "/")
+    if name.startswith(IGNORED_PREFIXES):
+        return None
+    path = posixpath.normpath(name)
+    # Absolute paths and ../ components could escape the target folder
+    if path.startswith(("/", "..")) or path == ".":
+        return None
+    parts = tuple(part for part in path.split("/") if part not in ("", "."))
+    if not parts or ".." in parts or parts[-1] in IGNORED_NAMES:
+        return None
+    return parts[:-1], parts[-1]
+
+
+def safe_member_name(name):
+    """A stored file or folder name as one archive path component.
+
+    Names come from users, a folder called ../../evil or a/b must not add
+    path levels when the archive is extracted.
+    """
+    name = (name or "").replace("/", "_").replace("\\", "_").replace("\0", "")
+    if name in ("", ".", ".."):
+        return "_"
+    return name
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def _iter_members(fileobj, filename):
+    # Yields (member name, readable stream) one member at a time
+    if filename.lower().endswith(".zip"):
+        try:
+            archive = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile as e:
+            raise InvalidArchive(str(e))
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as stream:
+                    yield info.filename, stream
+    else:
+        try:
+            # "r|*" reads the tar strictly sequentially, nothing is buffered
+            archive = tarfile.open(fileobj=fileobj, mode="r|*")
+        except tarfile.TarError as e:
+            raise InvalidArchive(str(e))
+        with archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                yield member.name, archive.extractfile(member)
+
+
+def spool_archive(fileobj, filename, max_entries, max_size=storage.MAX_UPLOAD_SIZE, max_total=None, spent=0):
+    """Spool every file of an archive into the blob spool, one entry at a time.
+
+    A few KB of zip can expand to terabytes, so max_total caps the extracted
+    bytes; spent of them are already used by other files of the same upload.
+    Blocking, run it off the event loop. On error the entries spooled so far
+    are discarded.
+    """
+    entries = []
+    try:
+        for name, stream in _iter_members(fileobj, filename):
+            path = split_member_path(name)
+            if path is None:
+                continue
+            if len(entries) >= max_entries:
+                raise InvalidArchive(f"Archive has more than {max_entries} files")
+            folder, member_filename = path
+            spool_path, size, content_hash = spool_within(stream, max_size, max_total, spent)
+            spent += size
+            entries.append(SpooledEntry(
+                folder, member_filename, guess_content_type(member_filename),
+                spool_path, size, content_hash
+            ))
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        discard_entries(entries)
+        raise InvalidArchive(str(e))
+    except BaseException:
+        discard_entries(entries)
+        raise
+    return entries
+
+
+def spool_within(stream, max_size, max_total, spent):
+    # spool_stream with whatever is left of a budget of max_total bytes
+    if max_total is None or max_total - spent >= max_size:
+        return storage.spool_stream(stream, max_size)
+    try:
+        return storage.spool_stream(stream, max_total - spent)
+    except storage.UploadTooLarge:
+        raise storage.UploadTooLarge(f"Files add up to more than the {max_total} byte limit")
+
+
+def discard_entries(entries):
+    for entry in entries:
+        storage.discard_spool(entry.spool_path)
+
+
+@dataclass
+class ArchiveMember:
+    arcname: str                # Path inside the archive, folders end with "/"
+    is_folder: bool
+    size: int
+    content_type: Optional[str]
+    open_chunks: Optional[object] = None   # Callable returning an iterator of bytes
+    mtime: Optional[float] = None
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that hands written bytes back out.
+
+    zipfile writes into it and stream_zip drains it after every chunk, so
+    only one chunk of archive output is buffered at a time.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(members):
+    """Yield a ZIP archive of members while it is being generated."""
+    sink = _ChunkSink()
+    # Unseekable output makes zipfile write data descriptors after each entry
+    with zipfile.ZipFile(sink, mode="w", allowZip64=True) as archive:
+        for member in members:
+            date_time = time.localtime(member.mtime or time.time())[:6]
+            if member.is_folder:
+                archive.writestr(zipfile.ZipInfo(member.arcname, date_time), b"")
+            else:
+                info = zipfile.ZipInfo(member.arcname, date_time)
+                # Deflate only what shrinks, stored entries cost no CPU
+                info.compress_type = (
+                    zipfile.ZIP_DEFLATED if storage.is_compressible(member.content_type) else zipfile.ZIP_STORED
+                )
+                with archive.open(info, mode="w", force_zip64=member.size >= zipfile.ZIP64_LIMIT) as entry:
+                    yield sink.drain()  # Local header goes out before any data is read
+                    for chunk in member.open_chunks():
+                        entry.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+
+def stream_tar(members):
+    """Yield an uncompressed tar archive of members while it is being generated.
+
+    Headers come from tarfile, member data is passed through chunk by chunk
+    (tarfile.addfile would copy a whole member in one call).
+    """
+    offset = 0
+    for member in members:
+        info = tarfile.TarInfo(member.arcname.rstrip("/"))
+        info.mtime = member.mtime or time.time()
+        if member.is_folder:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            info.size = member.size
+            info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        offset += len(header)
+        yield header
+        if not member.is_folder:
+            for chunk in member.open_chunks():
+                offset += len(chunk)
+                yield chunk
+            padding = -offset % tarfile.BLOCKSIZE
+            if padding:
+                offset += padding
+                yield tarfile.NUL * padding
+    # End of archive marker, then pad to a full record like tarfile does
+    end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    offset += len(end)
+    yield end + tarfile.NUL * (-offset % tarfile.RECORDSIZE)
@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy import delete, select
+
+import models
+from cache import TTLCache
+from database import AsyncSessionLocal
+
+# Tokens are HS256 JWTs signed with JWT_SECRET_KEY. Without it every process
+# signs with its own random key, so tokens do not survive restarts
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY") or secrets.token_urlsafe(32)
+# Worker count, uvicorn --workers and gunicorn take their default from it
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY") or 1)
+if not os.getenv("JWT_SECRET_KEY"):
+    # Each worker would reject the tokens the others signed, logins fail at random
+    if WEB_CONCURRENCY > 1:
+        raise RuntimeError(f"JWT_SECRET_KEY must be set to run {WEB_CONCURRENCY} workers")
+    # Same on Vercel, every function instance is a process of its own
+    if os.getenv("VERCEL"):
+        raise RuntimeError("JWT_SECRET_KEY must be set on Vercel")
+    print(
+        "WARNING: JWT_SECRET_KEY is not set, tokens are signed with a random key of this "
+        "process. They stop working on restart and with more than one worker."
+    )
+ACCESS_TOKEN_TTL = int(os.getenv("ACCESS_TOKEN_TTL", 8 * 60 * 60))
+# How long a worker trusts its cached answer before asking the database again
+REVOCATION_CACHE_TTL = float(os.getenv("REVOCATION_CACHE_TTL", 30))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+
+_SECRET = JWT_SECRET_KEY.encode()
+_HEADER = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b"=")
+
+revocation_cache = TTLCache(maxsize=10000, ttl=REVOCATION_CACHE_TTL)
+user_cache = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL)
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+class InvalidToken(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    id: int
+    name: str
+    email: str
+    role: str
+    token_id: str
+    expires_at: int
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=")
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+
+def _sign(signing_input):
+    return _b64encode(hmac.new(_SECRET, signing_input, hashlib.sha256).digest())
+
+
+def create_access_token(user):
+    now = int(time.time())
+    claims = {
+        "sub": str(user.id),
+        "role": user.role,
+        "jti": secrets.token_urlsafe(16),
+        "iat": now,
+        "exp": now + ACCESS_TOKEN_TTL,
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    signing_input = _HEADER + b"." + payload
+    return (signing_input + b"." + _sign(signing_input)).decode()
+
+
+def decode_access_token(token):
+    """Checks signature and expiry, pure CPU work in the microsecond range."""
+    try:
+        header, payload, signature = token.encode().split(b".")
+    except ValueError:
+        raise InvalidToken("Malformed token")
+    if header != _HEADER or not hmac.compare_digest(_sign(header + b"." + payload), signature):
+        raise InvalidToken("Invalid token signature")
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        raise InvalidToken("Malformed token")
+    if claims.get("exp", 0) <= time.time():
+        raise InvalidToken("Token expired")
+    return claims
+
+
+async def is_revoked(db, token_id):
+    revoked = revocation_cache.get(token_id)
+    if revoked is None:
+        revoked = await db.scalar(
+            select(models.RevokedToken.jti).where(models.RevokedToken.jti == token_id)
+        ) is not None
+        revocation_cache.set(token_id, revoked)
+    return revoked
+
+
+async def load_user(db, user_id):
+    # (name, email, role), or None when the user no longer exists
+    cached = user_cache.get(user_id)
+    if cached is None:
+        row = (await db.execute(
+            select(models.User.name, models.User.email, models.User.role)
+            .where(models.User.id == user_id)
+        )).first()
+        cached = tuple(row) if row else ()
+        user_cache.set(user_id, cached)
+    return cached or None
+
+
+async def revoke(db, user):
+    db.add(models.RevokedToken(
+        jti=user.token_id,
+        expires_at=datetime.fromtimestamp(user.expires_at, timezone.utc)
+    ))
+    # Entries for tokens that have expired anyway are no longer needed
+    await db.execute(
+        delete(models.RevokedToken).where(models.RevokedToken.expires_at < models.utcnow())
+    )
+    await db.commit()
+    revocation_cache.set(user.token_id, True, ttl=max(user.expires_at - time.time(), 0))
+
+
+async def get_current_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)
+) -> CurrentUser:
+    if credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    try:
+        claims = decode_access_token(credentials.credentials)
+        user_id = int(claims["sub"])
+        token_id = claims["jti"]
+    except (InvalidToken, KeyError, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=str(e) if isinstance(e, InvalidToken) else "Malformed token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+    user = user_cache.get(user_id)
+    revoked = revocation_cache.get(token_id)
+    if not user or revoked is None:
+        # Only cache misses reach the database, warm requests never do
+        async with AsyncSessionLocal() as db:
+            user = await load_user(db, user_id)
+            revoked = await is_revoked(db, token_id)
+    if not user or revoked:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token revoked or user no longer exists",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    name, email, role = user
+    return CurrentUser(user_id, name, email, role, token_id, claims["exp"])
+
+
+async def require_teacher(user: CurrentUser = Depends(get_current_user)) -> CurrentUser:
+    if user.role != "teacher":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Teacher access required")
+    return user
@@ -0,0 +1,110 @@
+"""Serialization cost of one /files/list page.
+
+Builds a listing of --rows entries and times turning it into response bytes
+the way the endpoint used to (dicts, jsonable_encoder, stdlib JSONResponse)
+and the way it does now (slotted ListItem rows encoded by orjson), with
+formatted and raw sizes:
+
+    python bench/list_serialization.py --rows 10000 --repeat 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main creates its tables on import, keep them out of the real database
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/bench.db")
+os.environ.setdefault("STORAGE_DIR", os.path.join(_tmp, "storage"))
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+import responses
+from main import ListItem, format_size
+
+Row = namedtuple("Row", "id filename size content_type is_folder parent_id")
+
+
+def make_rows(count):
+    return [
+        Row(i, f"lecture-notes-{i:05d}.pdf", (i * 7919) % (50 * 1024 * 1024), "application/pdf", i % 20 == 0, 42)
+        for i in range(count)
+    ]
+
+
+def before(rows):
+    item_list = []
+    for f in rows:
+        if f.is_folder:
+            size_str = "-"
+            type_str = "folder"
+        else:
+            size = f.size
+            if size < 1024:
+                size_str = f"{size} B"
+            elif size < 1024 * 1024:
+                size_str = f"{size / 1024:.1f} KB"
+            else:
+                size_str = f"{size / (1024 * 1024):.1f} MB"
+            type_str = f.content_type
+        item_list.append({
+            "id": f.id,
+            "name": f.filename,
+            "size": size_str,
+            "type": type_str,
+            "is_folder": f.is_folder,
+            "parent_id": f.parent_id
+        })
+    return JSONResponse(jsonable_encoder(item_list)).body
+
+
+def after(rows, raw=False):
+    return responses.dumps([
+        ListItem(
+            f.id,
+            f.filename,
+            (None if raw else "-") if f.is_folder else (f.size if raw else format_size(f.size)),
+            "folder" if f.is_folder else f.content_type,
+            f.is_folder,
+            f.parent_id
+        )
+        for f in rows
+    ])
+
+
+def best_of(func, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(rows)
+        timings.append(time.perf_counter() - start)
+    return min(timings), sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    cases = [
+        ("before: dicts + jsonable_encoder", before),
+        ("after: ListItem + " + ("orjson" if responses.orjson else "json"), after),
+        ("after, sizes=raw", lambda rows: after(rows, raw=True)),
+    ]
+    print(f"{args.rows} rows, best / median of {args.repeat}")
+    baseline = None
+    for name, func in cases:
+        best, median = best_of(func, rows, args.repeat)
+        baseline = baseline or best
+        print(f"  {name:<36} {best * 1000:8.2f} ms {median * 1000:8.2f} ms  x{baseline / best:.1f}")
+
+
+if __name__ == "__main__":
+    main()
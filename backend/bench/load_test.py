@@ -0,0 +1,199 @@
+"""Concurrent load test of the backend on a local SQLite database.
+
+Starts uvicorn on a scratch database and storage directory, then drives the
+register, login, list, upload, download and delete workloads one after the
+other with --concurrency clients each, and prints throughput and latency
+percentiles per workload:
+
+    python bench/load_test.py --users 50 --files 200 --concurrency 16
+    python bench/load_test.py --url http://127.0.0.1:8000   # existing server
+
+Exit status is 1 when any request failed, so it can gate a deploy.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, port, workers):
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{workdir}/load.db",
+        STORAGE_DIR=os.path.join(workdir, "storage"),
+        DB_PROFILE=os.environ.get("DB_PROFILE", "production"),
+        # Workers have to share the signing key, or tokens fail on the other ones
+        JWT_SECRET_KEY=os.environ.get("JWT_SECRET_KEY") or uuid.uuid4().hex,
+        WEB_CONCURRENCY=str(workers),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env=env
+    )
+
+
+async def wait_ready(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get("/files/list", params={"limit": 1})
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not come up")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Workload:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.failures = 0
+        self.elapsed = 0.0
+
+    def report(self):
+        values = sorted(self.latencies)
+        throughput = len(values) / self.elapsed if self.elapsed else 0.0
+        return (
+            f"{self.name:<10} {len(values):>6} {self.failures:>5} {throughput:>9.1f}"
+            f" {percentile(values, 50) * 1000:>8.1f} {percentile(values, 95) * 1000:>8.1f}"
+            f" {percentile(values, 99) * 1000:>8.1f}"
+        )
+
+
+async def run_workload(name, calls, concurrency):
+    """Run the request coroutine factories in calls with concurrency clients."""
+    workload = Workload(name)
+    pending = iter(calls)
+    results = []
+
+    async def client():
+        for call in pending:
+            start = time.perf_counter()
+            try:
+                response = await call()
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                response, ok = None, False
+            workload.latencies.append(time.perf_counter() - start)
+            if not ok:
+                workload.failures += 1
+            results.append(response)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    workload.elapsed = time.perf_counter() - start
+    return workload, results
+
+
+async def run(args, base_url):
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        await wait_ready(client)
+        run_id = uuid.uuid4().hex[:8]
+        password = "load-test-password"
+        users = [f"load-{run_id}-{i}@example.com" for i in range(args.users)]
+        payload = os.urandom(args.file_size // 2) + b"lecture notes " * (args.file_size // 28)
+        folder = (await client.post("/folders/create", json={"name": f"load-{run_id}"})).json()["id"]
+        workloads = []
+
+        workload, _ = await run_workload("register", [
+            lambda email=email: client.post("/auth/register", json={
+                "name": "Load Test", "email": email, "password": password, "role": "student"
+            })
+            for email in users
+        ], args.concurrency)
+        workloads.append(workload)
+
+        workload, _ = await run_workload("login", [
+            lambda email=email: client.post("/auth/login", json={"email": email, "password": password})
+            for email in users
+        ], args.concurrency)
+        workloads.append(workload)
+
+        workload, responses = await run_workload("upload", [
+            lambda i=i: client.post(
+                "/files/upload",
+                files={"file": (f"notes-{i}.txt", payload + str(i).encode(), "text/plain")},
+                data={"parent_id": str(folder)}
+            )
+            for i in range(args.files)
+        ], args.concurrency)
+        workloads.append(workload)
+        file_ids = [r.json()["id"] for r in responses if r is not None and r.status_code == 200]
+
+        workload, _ = await run_workload("list", [
+            lambda: client.get("/files/list", params={"parent_id": folder, "sizes": "raw"})
+            for _ in range(args.lists)
+        ], args.concurrency)
+        workloads.append(workload)
+
+        workload, _ = await run_workload("download", [
+            lambda file_id=file_id: client.get(f"/files/download/{file_id}")
+            for file_id in file_ids * args.downloads_per_file
+        ], args.concurrency)
+        workloads.append(workload)
+
+        workload, _ = await run_workload("delete", [
+            lambda file_id=file_id: client.delete(f"/files/delete/{file_id}")
+            for file_id in file_ids
+        ], args.concurrency)
+        workloads.append(workload)
+        await client.delete(f"/files/delete/{folder}")
+
+    print(f"{'workload':<10} {'reqs':>6} {'fail':>5} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for workload in workloads:
+        print(workload.report())
+    return sum(workload.failures for workload in workloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Test a running server instead of starting one")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the local server")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--lists", type=int, default=1000)
+    parser.add_argument("--downloads-per-file", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.url:
+        failures = asyncio.run(run(args, args.url))
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            port = free_port()
+            server = start_server(workdir, port, args.workers)
+            try:
+                failures = asyncio.run(run(args, f"http://127.0.0.1:{port}"))
+            finally:
+                server.terminate()
+                server.wait()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
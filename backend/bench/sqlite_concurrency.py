@@ -0,0 +1,94 @@
+"""Read/write concurrency of the SQLite engine profiles.
+
+Runs writer and reader threads against a scratch database for each profile
+in database.SQLITE_PROFILES and prints the operations per second:
+
+    python bench/sqlite_concurrency.py --writers 4 --readers 8 --seconds 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database import SQLITE_PROFILES, build_engine
+
+
+def run(profile, writers, readers, seconds, payload_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = build_engine(f"sqlite:///{tmp}/bench.db", profile)
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE files (id INTEGER PRIMARY KEY, parent_id INTEGER, filename TEXT, size INTEGER)"
+            ))
+            conn.execute(text("CREATE INDEX ix_parent ON files (parent_id, filename)"))
+
+        counts = {"write": 0, "read": 0, "error": 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def writer(n):
+            i = 0
+            while time.perf_counter() < deadline:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(
+                            text("INSERT INTO files (parent_id, filename, size) VALUES (:p, :f, :s)"),
+                            {"p": i % 50, "f": f"w{n}-{i}", "s": payload_size}
+                        )
+                    kind = "write"
+                except OperationalError:
+                    kind = "error"  # "database is locked"
+                i += 1
+                with lock:
+                    counts[kind] += 1
+
+        def reader(n):
+            i = 0
+            while time.perf_counter() < deadline:
+                try:
+                    with engine.connect() as conn:
+                        conn.execute(
+                            text("SELECT id, filename, size FROM files WHERE parent_id = :p ORDER BY filename LIMIT 100"),
+                            {"p": i % 50}
+                        ).all()
+                    kind = "read"
+                except OperationalError:
+                    kind = "error"
+                i += 1
+                with lock:
+                    counts[kind] += 1
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+        threads += [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        engine.dispose()
+
+    return {kind: count / seconds for kind, count in counts.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--payload-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    print(f"{'profile':<12}{'writes/s':>12}{'reads/s':>12}{'errors/s':>12}")
+    for profile in SQLITE_PROFILES:
+        result = run(profile, args.writers, args.readers, args.seconds, args.payload_size)
+        print(f"{profile:<12}{result['write']:>12.0f}{result['read']:>12.0f}{result['error']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
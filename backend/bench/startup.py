@@ -0,0 +1,105 @@
+"""Cold start cost of the backend: import, lifespan startup and first request.
+
+Each run is a fresh interpreter, as on a serverless cold start. It reports
+the time to import main and to run the lifespan startup (as uvicorn does),
+then the first and second GET /files/list served in process, for a fresh
+database and an already migrated one:
+
+    python bench/startup.py --runs 5
+    python bench/startup.py --backend-dir /path/to/other/checkout/backend
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import asyncio, json, sys, time
+import httpx  # Client side, not part of the app's start
+
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+
+async def lifespan(app):
+    # httpx.ASGITransport skips lifespan events, a server does not
+    inbox, outbox = asyncio.Queue(), asyncio.Queue()
+    task = asyncio.create_task(app({"type": "lifespan", "asgi": {"version": "3.0"}}, inbox.get, outbox.put))
+    await inbox.put({"type": "lifespan.startup"})
+    message = await outbox.get()
+    assert message["type"] == "lifespan.startup.complete", message
+
+    async def shutdown():
+        await inbox.put({"type": "lifespan.shutdown"})
+        await outbox.get()
+        await task
+    return shutdown
+
+
+async def requests():
+    start = time.perf_counter()
+    shutdown = await lifespan(main.app)
+    timings = [time.perf_counter() - start]
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(2):
+            start = time.perf_counter()
+            response = await client.get("/files/list")
+            assert response.status_code == 200, response.text
+            timings.append(time.perf_counter() - start)
+    await shutdown()
+    return timings
+
+startup, first, second = asyncio.run(requests())
+print(json.dumps({"import": imported - started, "startup": startup, "first": first, "second": second}))
+"""
+
+
+def run_once(backend_dir, database_url, storage_dir, extra_env):
+    env = dict(os.environ, DATABASE_URL=database_url, STORAGE_DIR=storage_dir, **extra_env)
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, backend_dir],
+        cwd=backend_dir, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend-dir", default=BACKEND_DIR)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_dir = os.path.join(tmp, "storage")
+        migrated_url = f"sqlite:///{tmp}/migrated.db"
+        # Creates and migrates the database the second scenario starts from
+        run_once(args.backend_dir, migrated_url, storage_dir, {})
+        scenarios = [
+            ("fresh database", lambda i: (f"sqlite:///{tmp}/fresh-{i}.db", {})),
+            ("migrated database", lambda i: (migrated_url, {})),
+            ("migrated, SCHEMA_MIGRATIONS=off", lambda i: (migrated_url, {"SCHEMA_MIGRATIONS": "off"})),
+        ]
+        print(f"median of {args.runs} runs, ms   {'import':>8} {'startup':>8} {'1st req':>8} {'2nd req':>8} {'total':>8}")
+        for name, setup in scenarios:
+            results = []
+            for i in range(args.runs):
+                database_url, extra_env = setup(i)
+                results.append(run_once(args.backend_dir, database_url, storage_dir, extra_env))
+            medians = {key: statistics.median(r[key] for r in results) * 1000 for key in results[0]}
+            total = medians["import"] + medians["startup"] + medians["first"]
+            print(
+                f"{name:<32} {medians['import']:>8.1f} {medians['startup']:>8.1f} {medians['first']:>8.1f}"
+                f" {medians['second']:>8.1f} {total:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""pytest-benchmark microbenchmarks of the hot request paths.
+
+Runs in process against a scratch SQLite database:
+
+    pytest bench/test_hot_paths.py --benchmark-autosave
+    pytest bench/test_hot_paths.py --benchmark-compare --benchmark-compare-fail=mean:25%
+
+The second form fails when a path got more than 25% slower than the last
+saved run.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/bench.db")
+os.environ.setdefault("STORAGE_DIR", os.path.join(_tmp, "storage"))
+# Hashing cost is not what these measure
+os.environ.setdefault("PASSWORD_HASH_ROUNDS", "1000")
+
+from fastapi.testclient import TestClient
+
+import auth
+import http_cache
+import main
+
+FILES = 500
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture(scope="module")
+def folder(client):
+    folder_id = client.post("/folders/create", json={"name": "bench"}).json()["id"]
+    client.post("/files/upload/bulk", files=[
+        ("files", (f"notes-{i:04d}.txt", f"lecture {i} on lathe tooling".encode(), "text/plain"))
+        for i in range(FILES)
+    ], data={"parent_id": str(folder_id)})
+    return folder_id
+
+
+@pytest.fixture(scope="module")
+def token(client):
+    user = {"name": "Bench", "email": "bench@example.com", "password": "bench-password", "role": "student"}
+    client.post("/auth/register", json=user)
+    return client.post("/auth/login", json={"email": user["email"], "password": user["password"]}).json()["access_token"]
+
+
+def test_list_cached(benchmark, client, folder):
+    response = benchmark(client.get, "/files/list", params={"parent_id": folder})
+    assert response.status_code == 200 and len(response.json()) == FILES
+
+
+def test_list_uncached(benchmark, client, folder):
+    def run():
+        main.listing_cache.clear()
+        return client.get("/files/list", params={"parent_id": folder, "sizes": "raw"})
+    assert benchmark(run).status_code == 200
+
+
+def test_list_not_modified(benchmark, client, folder):
+    etag = client.get("/files/list", params={"parent_id": folder}).headers["etag"]
+    response = benchmark(client.get, "/files/list", params={"parent_id": folder}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_listing_serialization(benchmark, folder):
+    rows = [main.ListItem(i, f"notes-{i}.txt", main.format_size(i * 1000), "text/plain", False, folder)
+            for i in range(10000)]
+    benchmark(main.dumps, rows)
+
+
+def test_download(benchmark, client, folder):
+    file_id = client.get("/files/list", params={"parent_id": folder, "limit": 1}).json()[0]["id"]
+    assert benchmark(client.get, f"/files/download/{file_id}").status_code == 200
+
+
+def test_search(benchmark, client, folder):
+    response = benchmark(client.get, "/files/search", params={"q": "lathe"})
+    assert response.status_code == 200
+
+
+def test_authenticated_request(benchmark, client, token):
+    response = benchmark(client.get, "/auth/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+
+
+def test_decode_access_token(benchmark, token):
+    assert benchmark(auth.decode_access_token, token)["sub"]
+
+
+def test_etag_matching(benchmark):
+    tags = ", ".join(http_cache.weak_etag(f"0-{i}-name-asc-500") for i in range(20))
+    assert benchmark(http_cache.etag_matches, tags, http_cache.weak_etag("0-19-name-asc-500"))
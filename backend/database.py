@@ -1,8 +1,12 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+import asyncio
 import os
+import threading
 
 # Check for environment variable (Production vs Local)
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
@@ -11,15 +15,189 @@ SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
 if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
     SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-# SQLite requires specific connect_args, Postgres does not
-if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
-    connect_args = {"check_same_thread": False}
-else:
-    connect_args = {}
+# Engine configuration. DB_PROFILE picks a preset, the individual variables
+# below override single settings of it
+DB_PROFILE = os.getenv("DB_PROFILE", "production")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args=connect_args
+# Connect-time pragmas per profile, "default" leaves SQLite's own settings alone
+SQLITE_PROFILES = {
+    "production": {
+        "journal_mode": "WAL",      # Readers no longer block the writer
+        "synchronous": "NORMAL",    # Durable at checkpoints, safe with WAL
+        "busy_timeout": 5000,       # Wait for the lock instead of failing at once
+        "cache_size": -65536,       # 64 MB page cache per connection
+        "mmap_size": 268435456,     # Read pages straight from a 256 MB mapping
+        "temp_store": "MEMORY",
+    },
+    "default": {},
+}
+
+POSTGRES_PROFILES = {
+    "production": {"pool_size": 10, "max_overflow": 20, "pool_timeout": 30, "pool_recycle": 1800, "pool_pre_ping": True},
+    "default": {},
+}
+
+POOL_SETTINGS = {
+    "pool_size": ("DB_POOL_SIZE", int),
+    "max_overflow": ("DB_MAX_OVERFLOW", int),
+    "pool_timeout": ("DB_POOL_TIMEOUT", float),
+    "pool_recycle": ("DB_POOL_RECYCLE", int),
+    "pool_pre_ping": ("DB_POOL_PRE_PING", lambda value: value.lower() in ("1", "true", "yes")),
+}
+
+
+def is_sqlite(url):
+    return str(url).startswith("sqlite")
+
+
+def sqlite_pragmas(profile=DB_PROFILE):
+    pragmas = dict(SQLITE_PROFILES[profile])
+    # e.g. SQLITE_PRAGMAS="cache_size=-20000,mmap_size=0"
+    for item in filter(None, os.getenv("SQLITE_PRAGMAS", "").split(",")):
+        name, _, value = item.partition("=")
+        pragmas[name.strip()] = value.strip()
+    return pragmas
+
+
+def engine_options(url, profile=DB_PROFILE):
+    if is_sqlite(url):
+        # SQLite requires specific connect_args, Postgres does not
+        return {"connect_args": {"check_same_thread": False}}
+    options = dict(POSTGRES_PROFILES[profile])
+    for option, (variable, parse) in POOL_SETTINGS.items():
+        if os.getenv(variable):
+            options[option] = parse(os.getenv(variable))
+    return options
+
+
+def apply_sqlite_pragmas(sync_engine, pragmas):
+    @event.listens_for(sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def build_engine(url=SQLALCHEMY_DATABASE_URL, profile=DB_PROFILE):
+    engine = create_engine(url, **engine_options(url, profile))
+    if is_sqlite(url):
+        apply_sqlite_pragmas(engine, sqlite_pragmas(profile))
+    return engine
+
+
+def build_async_engine(url=SQLALCHEMY_DATABASE_URL, profile=DB_PROFILE):
+    engine = create_async_engine(async_database_url(url), **engine_options(url, profile))
+    if is_sqlite(url):
+        apply_sqlite_pragmas(engine.sync_engine, sqlite_pragmas(profile))
+    return engine
+
+
+def async_database_url(url):
+    # Same database through an asyncio driver: aiosqlite locally, asyncpg for Postgres
+    url = make_url(url)
+    if url.drivername.startswith("sqlite"):
+        return url.set(drivername="sqlite+aiosqlite")
+    if url.drivername.startswith("postgresql"):
+        query = dict(url.query)
+        # asyncpg takes ssl instead of libpq's sslmode and has no channel_binding
+        if "sslmode" in query:
+            query["ssl"] = query.pop("sslmode")
+        query.pop("channel_binding", None)
+        return url.set(drivername="postgresql+asyncpg", query=query)
+    return url
+
+
+# Engines are built on first use, so importing this module costs no
+# connection pool and no driver import (cold starts)
+_engine = None
+_async_engine = None
+_init_lock = threading.RLock()
+
+# Called once, before the first session of the process is handed out
+# (main registers the schema migrations here)
+first_use_hooks = []
+_first_use_done = False
+
+
+def get_engine():
+    """Sync engine, used for schema management and scripts outside the event loop."""
+    global _engine
+    if _engine is None:
+        with _init_lock:
+            if _engine is None:
+                _engine = build_engine()
+    return _engine
+
+
+def get_async_engine():
+    """Async engine, used by the request handlers so queries never block the event loop."""
+    global _async_engine
+    if _async_engine is None:
+        with _init_lock:
+            if _async_engine is None:
+                _async_engine = build_async_engine()
+    return _async_engine
+
+
+def run_first_use_hooks():
+    global _first_use_done
+    if _first_use_done:
+        return
+    with _init_lock:
+        if _first_use_done:
+            return
+        for hook in first_use_hooks:
+            hook()
+        _first_use_done = True
+
+
+async def prepare():
+    """Run the first-use hooks on a worker thread, for callers on the event loop.
+
+    The first session would run them anyway, but blocking the loop meanwhile.
+    """
+    if not _first_use_done:
+        await asyncio.to_thread(run_first_use_hooks)
+
+
+def upsert(bind, table):
+    """INSERT for table that takes .on_conflict_do_update(), Postgres and SQLite spell it alike."""
+    if bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def __getattr__(name):
+    # database.engine / database.async_engine keep working, built on access
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazySessionmaker:
+    """Session factory that binds itself to its engine when first called."""
+
+    def __init__(self, factory, get_bind):
+        self._factory = factory
+        self._get_bind = get_bind
+        self._bound = False
+
+    def __call__(self, **kwargs):
+        if not self._bound:
+            run_first_use_hooks()
+            self._factory.configure(bind=self._get_bind())
+            self._bound = True
+        return self._factory(**kwargs)
+
+
+SessionLocal = LazySessionmaker(sessionmaker(autocommit=False, autoflush=False), get_engine)
+AsyncSessionLocal = LazySessionmaker(
+    async_sessionmaker(autoflush=False, expire_on_commit=False), get_async_engine
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
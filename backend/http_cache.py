@@ -0,0 +1,114 @@
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+
+def strong_etag(value):
+    return f'"{value}"'
+
+
+def weak_etag(value):
+    return f'W/"{value}"'
+
+
+def http_date(dt):
+    # SQLite hands datetimes back naive, they are always stored as UTC
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return format_datetime(dt.astimezone(timezone.utc), usegmt=True)
+
+
+def _opaque(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison function (RFC 9110 13.1.2)
+    if if_none_match.strip() == "*":
+        return True
+    wanted = _opaque(etag)
+    return any(_opaque(tag.strip()) == wanted for tag in if_none_match.split(","))
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """True when the conditional headers of request say the client copy is current."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is present
+        return etag is not None and etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # HTTP dates have one second resolution
+    return last_modified.replace(microsecond=0) <= since
+
+
+def accepts_encoding(request, encoding):
+    """Whether Accept-Encoding allows a response body in encoding."""
+    for item in request.headers.get("accept-encoding", "").split(","):
+        token, _, params = item.partition(";")
+        if token.strip().lower() not in (encoding, "*"):
+            continue
+        name, _, value = params.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def _if_range_matches(if_range, etag, last_modified):
+    # If-Range takes a strong entity tag or the exact Last-Modified date (RFC 9110 13.1.5)
+    if_range = if_range.strip()
+    if if_range.startswith(("\"", "W/")):
+        return etag is not None and not etag.startswith("W/") and if_range == etag
+    return last_modified is not None and if_range == http_date(last_modified)
+
+
+def single_range(request, size, etag=None, last_modified=None):
+    """(start, end) with end inclusive for a Range request of one range, else None.
+
+    None means sending the whole representation: no or unparsable Range, a
+    stale If-Range, or several ranges (not worth a multipart body for content
+    that is decoded on the fly). Raises RangeNotSatisfiable.
+    """
+    header = request.headers.get("range")
+    if not header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and not _if_range_matches(if_range, etag, last_modified):
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range, the last n bytes
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start < 0:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if end < start:
+        return None
+    return start, min(end, size - 1)
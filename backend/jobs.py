@@ -0,0 +1,209 @@
+import asyncio
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+from sqlalchemy import insert, select, update
+
+import database
+import models
+from database import AsyncSessionLocal
+
+# Heavy steps run on this pool, "process" keeps CPU bound work off the GIL
+JOB_EXECUTOR = os.getenv("JOB_EXECUTOR", "thread")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", min(4, os.cpu_count() or 1)))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# First retry waits this long, every further one twice as long
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 5))
+# Jobs left "running" longer than this belonged to a worker that died
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", 15 * 60))
+# Unfinished jobs of a previous run are requeued this long after start, so a
+# cold start does not wait for the database (and its migrations)
+JOB_RECOVERY_DELAY = float(os.getenv("JOB_RECOVERY_DELAY", 10))
+
+# kind -> async handler(db, job), returns a short result string
+HANDLERS = {}
+
+_queue = None
+_workers = []
+_recovery = None
+_executor = None
+
+
+def handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        pool = ProcessPoolExecutor if JOB_EXECUTOR == "process" else ThreadPoolExecutor
+        _executor = pool(max_workers=JOB_WORKERS)
+    return _executor
+
+
+async def run_blocking(func, *args):
+    """Run func(*args) on the job pool. With the process pool func must be importable."""
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+
+
+async def enqueue(db, kinds, file_ids):
+    """Add one job per kind and file in the current transaction, returns the job ids.
+
+    Call submit() with the ids once the transaction has committed.
+    """
+    rows = [
+        {"kind": kind, "file_id": file_id, "max_attempts": JOB_MAX_ATTEMPTS}
+        for file_id in file_ids for kind in kinds
+    ]
+    if not rows:
+        return []
+    return list((await db.scalars(insert(models.Job).returning(models.Job.id), rows)).all())
+
+
+def submit(job_ids):
+    # Without running workers the jobs stay pending and are picked up on the next start
+    if _queue is not None:
+        for job_id in job_ids:
+            _queue.put_nowait(job_id)
+
+
+def _submit_later(job_id, delay):
+    asyncio.get_running_loop().call_later(delay, submit, [job_id])
+
+
+async def _claim(db, job_id):
+    # Conditional update so that only one worker (or process) runs a job
+    claimed = await db.execute(
+        update(models.Job)
+        .where(models.Job.id == job_id, models.Job.status == "pending")
+        .values(status="running", attempts=models.Job.attempts + 1, updated_at=models.utcnow())
+    )
+    await db.commit()
+    if claimed.rowcount != 1:
+        return None
+    return await db.get(models.Job, job_id)
+
+
+async def _run(job_id):
+    async with AsyncSessionLocal() as db:
+        job = await _claim(db, job_id)
+        if job is None:
+            return
+        # The rollback below expires the instance, keep what is needed afterwards
+        kind, attempts, max_attempts = job.kind, job.attempts, job.max_attempts
+        try:
+            func = HANDLERS[kind]
+            result = await func(db, job)
+        except Exception as e:
+            await db.rollback()
+            error = "".join(traceback.format_exception_only(type(e), e)).strip()
+            print(f"Job {job_id} ({kind}) failed, attempt {attempts}: {error}")
+            values = {"last_error": error[:2000], "updated_at": models.utcnow()}
+            if attempts < max_attempts:
+                delay = JOB_RETRY_DELAY * 2 ** (attempts - 1)
+                values.update(status="pending", run_after=models.utcnow() + timedelta(seconds=delay))
+            else:
+                delay = None
+                values.update(status="failed")
+            await db.execute(update(models.Job).where(models.Job.id == job_id).values(**values))
+            await db.commit()
+            if delay is not None:
+                _submit_later(job_id, delay)
+        else:
+            await db.execute(
+                update(models.Job).where(models.Job.id == job_id)
+                .values(status="done", result=result, last_error=None, updated_at=models.utcnow())
+            )
+            await db.commit()
+
+
+async def _worker():
+    while True:
+        job_id = await _queue.get()
+        try:
+            await _run(job_id)
+        except Exception as e:
+            # The job row stays as it is, a restart picks it up again
+            print(f"Job worker error on job {job_id}: {e}")
+        finally:
+            _queue.task_done()
+
+
+async def _recover():
+    # Requeue what a previous run left behind
+    await database.prepare()
+    async with AsyncSessionLocal() as db:
+        stale = models.utcnow() - timedelta(seconds=JOB_STALE_AFTER)
+        await db.execute(
+            update(models.Job)
+            .where(models.Job.status == "running", models.Job.updated_at < stale)
+            .values(status="pending")
+        )
+        await db.commit()
+        now = models.utcnow()
+        pending = (await db.execute(
+            select(models.Job.id, models.Job.run_after)
+            .where(models.Job.status == "pending")
+            .order_by(models.Job.id)
+        )).all()
+    for job_id, run_after in pending:
+        if run_after.tzinfo is None:
+            run_after = run_after.replace(tzinfo=now.tzinfo)
+        delay = (run_after - now).total_seconds()
+        if delay > 0:
+            _submit_later(job_id, delay)
+        else:
+            submit([job_id])
+    return len(pending)
+
+
+async def _recover_later(delay):
+    await asyncio.sleep(delay)
+    try:
+        recovered = await _recover()
+    except Exception as e:
+        # Left for the next start, new jobs are not affected
+        print(f"Could not requeue unfinished jobs: {e}")
+        return
+    if recovered:
+        print(f"Requeued {recovered} unfinished jobs")
+
+
+async def start(recovery_delay=None):
+    """Start the workers, touches no database. Recovery follows in the background."""
+    global _queue, _recovery
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue()
+    _workers.extend(asyncio.create_task(_worker()) for _ in range(JOB_WORKERS))
+    delay = JOB_RECOVERY_DELAY if recovery_delay is None else recovery_delay
+    _recovery = asyncio.create_task(_recover_later(delay))
+
+
+async def stop():
+    global _queue, _recovery, _executor
+    tasks = _workers + ([_recovery] if _recovery is not None else [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _workers.clear()
+    _recovery = None
+    _queue = None
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def queued():
+    return _queue.qsize() if _queue is not None else 0
+
+
+async def drain():
+    """Wait until every queued job has been processed (retries scheduled later excluded)."""
+    if _queue is not None:
+        await _queue.join()
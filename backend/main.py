@@ -1,40 +1,70 @@
 # VERSION: 2.0-NO-REQUESTS
-from fastapi import FastAPI, HTTPException, status, UploadFile, File, Depends, Body
+import os
 
 from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
+# Load environment variables before any module reads its settings. An explicit
+# path skips python-dotenv's search through the caller's directories
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+
+from fastapi import FastAPI, HTTPException, status, Depends, Body, Request, Response, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
-import os
+from sqlalchemy import delete, func, insert, literal, or_, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
 import shutil
-from typing import List, Optional
+import base64
+import re
+import json
+from dataclasses import dataclass
+from datetime import timezone
+from functools import partial
+from urllib.parse import quote
+from typing import List, Literal, Optional, Union
 
 # SECURITY: Master code for teacher access
 TEACHER_SECRET_CODE = "DKTE_Mech_2026"
 
-from database import SessionLocal, engine, Base
+import database
+from database import AsyncSessionLocal, SessionLocal
 import models
+import storage
+import http_cache
+import passwords
+import auth
+import archives
+import search
+from cache import TTLCache
+from responses import FastJSONResponse, dumps
+import jobs
+import processing
+import previews
+import metrics
+import profiling
+import migrations
+import resumable
+import upload_stream
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Schema is managed by migrations.py. Nothing touches the database at import,
+# pending migrations are applied before the first session (SCHEMA_MIGRATIONS)
+database.first_use_hooks.append(migrations.auto_migrate)
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
-# Password Hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# On the Engine class, so it covers both engines whenever they get built
+metrics.instrument_engine(Engine)
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    # Pending migrations of the first request run off the event loop
+    await database.prepare()
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # CORS Configuration
 # Allow all origins via regex to handle localhost ports and Vercel domains dynamically
@@ -55,13 +85,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Location", "Upload-Offset", "Upload-Length"],
 )
+# Outermost, so the timings include CORS handling and preflight requests
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Opt-in slow query log, EXPLAIN plans and N+1 warnings (SQL_PROFILE=1)
+if profiling.SQL_PROFILE:
+    profiling.instrument_engine(Engine)
+    app.add_middleware(profiling.QueryProfileMiddleware)
 
 @app.on_event("startup")
 async def startup_event():
+    await jobs.start()
     print("Backend server is ready at http://127.0.0.1:8000")
 
-# UPLOAD_DIR logic removed as files are stored in DB
+@app.on_event("shutdown")
+async def shutdown_event():
+    await jobs.stop()
 
 # Pydantic Models
 class UserRegister(BaseModel):
@@ -86,23 +127,27 @@ class UserResponse(BaseModel):
     class Config:
         from_attributes = True
 
-# Helper Functions
-# Use pbkdf2_sha256 which is pure python and robust on Windows
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+class LoginResponse(UserResponse):
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# Helper Functions
+# Hashing runs on the bounded pool in passwords.py, never on the event loop
+def hash_queue_full():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please try again shortly",
+        headers={"Retry-After": "1"}
+    )
 
 # Auth Endpoints
 @app.post("/auth/register", response_model=UserResponse)
-async def register(user: UserRegister, db: Session = Depends(get_db)):
+async def register(user: UserRegister, db: AsyncSession = Depends(get_db)):
     print(f"Attempting to register user: {user.email}") # Debug log
     try:
         # Check if user exists
-        db_user = db.query(models.User).filter(models.User.email == user.email).first()
+        db_user = await db.scalar(select(models.User).where(models.User.email == user.email))
         if db_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -118,7 +163,10 @@ async def register(user: UserRegister, db: Session = Depends(get_db)):
                 )
          
          # Hash password
-        hashed_password = get_password_hash(user.password)
+        try:
+            hashed_password = await passwords.hash_password(user.password)
+        except passwords.HashQueueFull:
+            raise hash_queue_full()
         
         # Create new user
         new_user = models.User(
@@ -129,8 +177,8 @@ async def register(user: UserRegister, db: Session = Depends(get_db)):
         )
         
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         print(f"User registered successfully: {new_user.id}")
         return new_user
     except Exception as e:
@@ -144,13 +192,19 @@ async def register(user: UserRegister, db: Session = Depends(get_db)):
             detail=f"Registration failed: {str(e)}"
         )
 
-@app.post("/auth/login", response_model=UserResponse)
-async def login(user: UserLogin, db: Session = Depends(get_db)):
+@app.post("/auth/login", response_model=LoginResponse)
+async def login(user: UserLogin, db: AsyncSession = Depends(get_db)):
     # Find user
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    
+    db_user = await db.scalar(select(models.User).where(models.User.email == user.email))
+
     # Verify
-    if not db_user or not verify_password(user.password, db_user.password_hash):
+    valid, new_hash = False, None
+    if db_user:
+        try:
+            valid, new_hash = await passwords.verify_password(user.password, db_user.password_hash)
+        except passwords.HashQueueFull:
+            raise hash_queue_full()
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or password"
@@ -163,145 +217,1085 @@ async def login(user: UserLogin, db: Session = Depends(get_db)):
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Invalid Teacher Secret Code. Please enter the master code to log in."
             )
-        
-    return db_user
 
-from fastapi.responses import StreamingResponse
-import io
-from fastapi import Form
+    # Hash cost changed since this password was stored, upgrade it transparently
+    if new_hash:
+        db_user.password_hash = new_hash
+        await db.commit()
+
+    # Later requests present this token instead of the password
+    return LoginResponse(
+        name=db_user.name,
+        email=db_user.email,
+        role=db_user.role,
+        access_token=auth.create_access_token(db_user),
+        expires_in=auth.ACCESS_TOKEN_TTL
+    )
+
+@app.get("/auth/me", response_model=UserResponse)
+async def me(user: auth.CurrentUser = Depends(auth.get_current_user)):
+    return user
+
+@app.post("/auth/logout")
+async def logout(user: auth.CurrentUser = Depends(auth.get_current_user), db: AsyncSession = Depends(get_db)):
+    await auth.revoke(db, user)
+    return {"message": "Logged out"}
+
+@app.get("/metrics/password-hashing")
+async def password_hashing_metrics():
+    return {"pending": passwords.pending(), "queue_wait": passwords.queue_wait.snapshot()}
+
+# Read at scrape time from the modules that keep them
+metrics.Gauge("password_hash_pending", "Password hashes running or waiting for a worker.",
+              callback=passwords.pending)
+metrics.Counter("password_hash_queue_wait_seconds_total", "Time password hashes waited for a worker.",
+                callback=lambda: passwords.queue_wait.total)
+metrics.Counter("password_hash_total", "Password hashes and verifications run.",
+                callback=lambda: passwords.queue_wait.count)
+metrics.Gauge("password_hash_queue_wait_seconds_max", "Longest wait for a hashing worker so far.",
+              callback=lambda: passwords.queue_wait.max)
+metrics.Gauge("jobs_queued", "Post-upload jobs waiting for a worker in this process.", callback=jobs.queued)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 # Request Models
 class FolderCreate(BaseModel):
     name: str
     parent_id: Optional[int] = None
 
+# Response models of the file endpoints. Plain slotted dataclasses, built per
+# row without validation and serialized by orjson in one go
+@dataclass(slots=True)
+class ListItem:
+    id: int
+    name: str
+    size: Union[str, int, None]  # "1.2 MB" or bytes with sizes=raw (None for folders)
+    type: Optional[str]
+    is_folder: bool
+    parent_id: Optional[int]
+
+@dataclass(slots=True)
+class SearchResult:
+    id: int
+    name: str
+    size: Optional[int]
+    type: Optional[str]
+    is_folder: bool
+    parent_id: Optional[int]
+    snippet: Optional[str]
+
+# Folder versions (validators for folder listings)
+ROOT_FOLDER_KEY = 0
+
+# Rendered listing pages, see list_files. Other workers never see stale pages
+# because every request checks the folder version in the database first
+LIST_CACHE_SIZE = int(os.getenv("LIST_CACHE_SIZE", 256))  # Folders
+LIST_CACHE_TTL = float(os.getenv("LIST_CACHE_TTL", 300))
+LIST_CACHE_PAGES = 16  # Per folder, sort orders and page positions together
+listing_cache = TTLCache(maxsize=LIST_CACHE_SIZE, ttl=LIST_CACHE_TTL)
+
+def folder_key(parent_id):
+    return ROOT_FOLDER_KEY if parent_id is None else parent_id
+
+async def bump_folder_version(db, parent_id):
+    key = folder_key(parent_id)
+    # Drop this worker's cached pages right away, other workers notice the
+    # new version on their next request
+    listing_cache.pop(key)
+    # One statement, two workers bumping a folder that has no row yet both count
+    versions = models.FolderVersion.__table__
+    stmt = database.upsert(db.bind, versions).values(folder_id=key, version=1, updated_at=models.utcnow())
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[versions.c.folder_id],
+        set_={"version": versions.c.version + 1, "updated_at": stmt.excluded.updated_at}
+    ))
+
+async def bump_subtree_versions(db, item_id):
+    # Deleted folders keep their rows, bumped. SQLite reuses the ids of
+    # deleted rows, a new folder must not revalidate the old one's listing
+    versions = models.FolderVersion.__table__
+    stmt = database.upsert(db.bind, versions).from_select(
+        ["folder_id", "version", "updated_at"],
+        select(
+            models.DBFile.id, literal(1), literal(models.utcnow(), versions.c.updated_at.type)
+        ).where(models.DBFile.id.in_(subtree_ids(item_id)), models.DBFile.is_folder.is_(True))
+    )
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[versions.c.folder_id],
+        set_={"version": versions.c.version + 1, "updated_at": stmt.excluded.updated_at}
+    ))
+
+async def get_folder_version(db, parent_id):
+    return await db.scalar(select(models.FolderVersion).where(
+        models.FolderVersion.folder_id == folder_key(parent_id)
+    ))
+
+def file_etag(db_file, encoding=None):
+    # Content hash makes a strong validator, legacy inline rows have none.
+    # The encoded representation is a different byte sequence, so its own tag
+    if not db_file.content_hash:
+        return None
+    return http_cache.strong_etag(f"{db_file.content_hash}-{encoding}" if encoding else db_file.content_hash)
+
+# Listing sort keys, id breaks ties so every keyset position is unique
+LIST_SORT_COLUMNS = {
+    "name": models.DBFile.filename,
+    "size": models.DBFile.size,
+    # NULL content types sort as ''
+    "type": models.content_type_key,
+}
+# What a cursor may carry as the last sort value, per sort key
+LIST_SORT_TYPES = {"name": (str, type(None)), "size": (int, type(None)), "type": (str, type(None))}
+LIST_DEFAULT_LIMIT = 500
+LIST_MAX_LIMIT = 1000
+
+def encode_cursor(sort, order, value, item_id):
+    raw = json.dumps([sort, order, value, item_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor, sort, order):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_order, value, item_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise HTTPException(status_code=400, detail="Cursor does not match sort order")
+    # Both end up as query parameters, the client could have put anything there
+    valid_value = isinstance(value, LIST_SORT_TYPES[sort]) and not isinstance(value, bool)
+    if not valid_value or not isinstance(item_id, int) or isinstance(item_id, bool):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if sort == "type" and value is None:
+        value = ""  # Cursors from before the type sort used COALESCE
+    return value, item_id
+
 # File/Folder Endpoints
 
-@app.get("/files/list")
-async def list_files(parent_id: Optional[int] = None, db: Session = Depends(get_db)):
-    # Query items with specific parent_id (Folder browsing)
-    items_db = db.query(
+def format_size(size):
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.1f} KB"
+    return f"{size / (1024 * 1024):.1f} MB"
+
+async def query_listing(db, parent_id, sort, order, limit, cursor, sizes="formatted"):
+    # One page of a folder as JSON bytes, plus the cursor of the next page if any
+    sort_column = LIST_SORT_COLUMNS[sort]
+    query = select(
         models.DBFile.id,
-        models.DBFile.filename, 
-        models.DBFile.size, 
+        models.DBFile.filename,
+        models.DBFile.size,
         models.DBFile.content_type,
         models.DBFile.is_folder,
         models.DBFile.parent_id
-    ).filter(models.DBFile.parent_id == parent_id).all()
-    
-    item_list = []
-    for f in items_db:
-        if f.is_folder:
-            size_str = "-"
-            type_str = "folder"
-        else:
-            size = f.size
-            if size < 1024:
-                size_str = f"{size} B"
-            elif size < 1024 * 1024:
-                size_str = f"{size / 1024:.1f} KB"
-            else:
-                size_str = f"{size / (1024 * 1024):.1f} MB"
-            type_str = f.content_type
-
-        item_list.append({
-            "id": f.id,
-            "name": f.filename,
-            "size": size_str,
-            "type": type_str,
-            "is_folder": f.is_folder,
-            "parent_id": f.parent_id
-        })
-    return item_list
+    ).where(models.DBFile.parent_id == parent_id)
+
+    if cursor:
+        # Keyset: continue strictly after the last row of the previous page
+        value, last_id = decode_cursor(cursor, sort, order)
+        position = tuple_(sort_column, models.DBFile.id)
+        query = query.where(position > (value, last_id) if order == "asc" else position < (value, last_id))
+
+    if order == "asc":
+        query = query.order_by(sort_column.asc(), models.DBFile.id.asc())
+    else:
+        query = query.order_by(sort_column.desc(), models.DBFile.id.desc())
+
+    # One extra row tells whether another page follows
+    items_db = (await db.execute(query.limit(limit + 1))).all()
+    next_cursor = None
+    if len(items_db) > limit:
+        items_db = items_db[:limit]
+        last = items_db[-1]
+        last_value = {"name": last.filename, "size": last.size, "type": last.content_type or ""}[sort]
+        next_cursor = encode_cursor(sort, order, last_value, last.id)
+
+    raw = sizes == "raw"
+    item_list = [
+        ListItem(
+            f.id,
+            f.filename,
+            (None if raw else "-") if f.is_folder else (f.size if raw else format_size(f.size)),
+            "folder" if f.is_folder else f.content_type,
+            f.is_folder,
+            f.parent_id
+        )
+        for f in items_db
+    ]
+    return dumps(item_list), next_cursor
+
+@app.get("/files/list", response_model=List[ListItem])
+async def list_files(
+    request: Request,
+    parent_id: Optional[int] = None,
+    sort: Literal["name", "size", "type"] = "name",
+    order: Literal["asc", "desc"] = "asc",
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    # "raw" leaves formatting the byte counts to the client
+    sizes: Literal["formatted", "raw"] = "formatted",
+    db: AsyncSession = Depends(get_db)
+):
+    folder_version = await get_folder_version(db, parent_id)
+    version = folder_version.version if folder_version else 0
+    updated_at = folder_version.updated_at if folder_version else None
+    # Each page is its own representation, so the page parameters are in the tag
+    etag = http_cache.weak_etag(
+        f"{folder_key(parent_id)}-{version}-{sort}-{order}-{limit}-{sizes}-{cursor or ''}"
+    )
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if updated_at:
+        headers["Last-Modified"] = http_cache.http_date(updated_at)
+    if http_cache.is_not_modified(request, etag, updated_at):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Pages are reused only while the folder is at the version they were built
+    # from. updated_at guards against a deleted folder's id being reused
+    key = folder_key(parent_id)
+    validator = (version, updated_at)
+    page_key = (sort, order, limit, sizes, cursor)
+    cached = listing_cache.get(key)
+    if cached is not None and cached[0] == validator and page_key in cached[1]:
+        body, next_cursor = cached[1][page_key]
+    else:
+        body, next_cursor = await query_listing(db, parent_id, sort, order, limit, cursor, sizes)
+        if cached is None or cached[0] != validator:
+            cached = (validator, {})
+            listing_cache.set(key, cached)
+        if len(cached[1]) < LIST_CACHE_PAGES:
+            cached[1][page_key] = (body, next_cursor)
+
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(body, media_type="application/json", headers=headers)
 
 @app.post("/folders/create")
-async def create_folder(folder: FolderCreate, db: Session = Depends(get_db)):
+async def create_folder(folder: FolderCreate, db: AsyncSession = Depends(get_db)):
     new_folder = models.DBFile(
         filename=folder.name,
         content_type="application/x-directory",
         size=0,
-        data=b"",
         is_folder=True,
         parent_id=folder.parent_id
     )
     db.add(new_folder)
-    db.commit()
-    db.refresh(new_folder)
+    await bump_folder_version(db, folder.parent_id)
+    try:
+        await db.flush()
+        await search.index_file(db, new_folder.id, new_folder.filename)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="An item with this name already exists in this folder"
+        )
+    await db.refresh(new_folder)
     return {"id": new_folder.id, "name": new_folder.filename, "is_folder": True}
 
-@app.post("/files/upload")
-async def upload_file(
-    file: UploadFile = File(...), 
-    parent_id: Optional[int] = Form(None),
-    db: Session = Depends(get_db)
+async def save_file(db, spool_path, size, content_hash, filename, content_type, parent_id, encoding=None):
+    """Turn a spooled body into a DBFile, replacing one of the same name. Commits.
+
+    With spool_path None the content is already stored and referenced in this
+    transaction, with encoding. Returns (file id, post-upload job ids).
+    Pending changes of the session are committed together with the file.
+    """
+    try:
+        # Check if exists in this specific folder
+        existing_file = await db.scalar(select(models.DBFile).where(
+            models.DBFile.filename == filename,
+            models.DBFile.parent_id == parent_id
+        ))
+
+        released = []
+        if existing_file and existing_file.is_folder:
+            # Replacing would drop the folder row and strand its contents
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"A folder named {filename} already exists"
+            )
+        if existing_file:
+            released = await storage.release_blobs(db, [existing_file.content_hash])
+            await search.unindex(db, [existing_file.id])
+            await db.delete(existing_file)
+            await db.flush()  # Free the (parent_id, filename) slot before the insert
+
+        if spool_path is not None:
+            # Identical content already in the store is referenced, not written again
+            encoding = await storage.store_blob(db, spool_path, content_hash, size, content_type)
+
+        new_file = models.DBFile(
+            filename=filename,
+            content_type=content_type,
+            size=size,
+            content_hash=content_hash,
+            content_encoding=encoding,
+            parent_id=parent_id,
+            is_folder=False
+        )
+        db.add(new_file)
+        await bump_folder_version(db, parent_id)
+        await db.flush()
+        file_id = new_file.id
+        job_ids = await jobs.enqueue(db, processing.POST_UPLOAD_JOBS, [file_id])
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        if spool_path is not None:
+            storage.discard_spool(spool_path)
+        raise
+
+    await storage.collect_blobs(db, released)
+    # The bytes and the job rows are committed, processing happens off the request path
+    jobs.submit(job_ids)
+    return file_id, job_ids
+
+def form_parent_id(value):
+    # Forms read by hand, what FastAPI's Form(None) did for Optional[int]
+    try:
+        return int(value) if value else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="parent_id must be an integer")
+
+def form_body(**properties):
+    # OpenAPI description of a multipart body an endpoint reads by hand
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object", "required": [next(iter(properties))], "properties": properties
+    }}}}}
+
+BINARY = {"type": "string", "format": "binary"}
+
+async def read_streamed_form(request, **limits):
+    # upload_stream.read_upload_form with its errors as responses
+    try:
+        return await upload_stream.read_upload_form(request, **limits)
+    except storage.UploadTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except upload_stream.InvalidForm as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ClientDisconnect:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Upload interrupted")
+
+@app.post("/files/upload", openapi_extra=form_body(file=BINARY, parent_id={"type": "integer"}))
+async def upload_file(request: Request, db: AsyncSession = Depends(get_db)):
+    # The multipart body is parsed as it arrives and the file written to the
+    # spool in fixed-size chunks, never held whole or copied (upload_stream)
+    form = await read_streamed_form(request)
+    if not form.files:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="No file in the upload")
+    upload = form.files[0]
+    try:
+        parent_id = form_parent_id(form.fields.get("parent_id"))
+    except HTTPException:
+        storage.discard_spool(upload.spool_path)
+        raise
+
+    file_id, job_ids = await save_file(
+        db, upload.spool_path, upload.size, upload.content_hash, upload.filename, upload.content_type, parent_id
+    )
+    return {"filename": upload.filename, "id": file_id, "jobs": job_ids}
+
+# Instant uploads: the client sends the SHA-256 and size first, content the
+# store already holds is linked without the body crossing the wire. Knowing
+# a hash and size is as good as having the file, which grants nothing here,
+# every file can be listed and downloaded anyway
+SHA256_HEX = re.compile(r"[0-9a-f]{64}")
+
+class InstantUpload(BaseModel):
+    filename: str
+    content_hash: str
+    size: int
+    content_type: Optional[str] = None
+    parent_id: Optional[int] = None
+
+@app.post("/files/upload/instant")
+async def upload_instant(upload: InstantUpload, db: AsyncSession = Depends(get_db)):
+    content_hash = upload.content_hash.lower()
+    if not SHA256_HEX.fullmatch(content_hash):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="content_hash must be a SHA-256 hex digest")
+
+    # A primary key lookup on blobs.hash, however many files there are
+    blob = await storage.reference_blob(db, content_hash, upload.size)
+    if blob is None or not await run_in_threadpool(storage.blob_store.exists, content_hash, blob.encoding):
+        await db.rollback()
+        # Not stored yet, the client sends the body through a regular upload
+        return {"instant": False}
+
+    file_id, job_ids = await save_file(
+        db, None, upload.size, content_hash, upload.filename, upload.content_type, upload.parent_id,
+        encoding=blob.encoding
+    )
+    return {"instant": True, "filename": upload.filename, "id": file_id, "jobs": job_ids}
+
+# Resumable uploads (resumable.py), for large files over unreliable connections
+class UploadCreate(BaseModel):
+    filename: str
+    length: int
+    content_type: Optional[str] = None
+    parent_id: Optional[int] = None
+
+def upload_headers(session):
+    return {
+        "Upload-Offset": str(session.received),
+        "Upload-Length": str(session.length),
+        "Cache-Control": "no-store",
+    }
+
+async def get_upload_session(db, upload_id):
+    session = await resumable.get_session(db, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found or expired")
+    return session
+
+@app.post("/uploads", status_code=status.HTTP_201_CREATED)
+async def create_upload(upload: UploadCreate, db: AsyncSession = Depends(get_db)):
+    if upload.length < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid length")
+    if upload.length > storage.MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File exceeds the {storage.MAX_UPLOAD_SIZE} byte limit"
+        )
+    await resumable.collect_expired(db)
+
+    upload_id = resumable.new_session_id()
+    await run_in_threadpool(resumable.create_part, upload_id)
+    session = models.UploadSession(
+        id=upload_id,
+        filename=upload.filename,
+        content_type=upload.content_type,
+        parent_id=upload.parent_id,
+        length=upload.length,
+        received=0,
+        expires_at=resumable.expires_at()
+    )
+    db.add(session)
+    await db.commit()
+    return FastJSONResponse(
+        {"id": upload_id, "offset": 0, "length": upload.length},
+        status_code=status.HTTP_201_CREATED,
+        headers={**upload_headers(session), "Location": f"/uploads/{upload_id}"}
+    )
+
+@app.api_route("/uploads/{upload_id}", methods=["GET", "HEAD"])
+async def get_upload(upload_id: str, db: AsyncSession = Depends(get_db)):
+    # Where to resume from, after an interrupted PATCH
+    session = await get_upload_session(db, upload_id)
+    return FastJSONResponse(
+        {"id": session.id, "offset": session.received, "length": session.length},
+        headers=upload_headers(session)
+    )
+
+@app.patch("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset"),
+    db: AsyncSession = Depends(get_db)
 ):
-    request_object_content = await file.read()
-    
-    # Check if exists in this specific folder
-    existing_file = db.query(models.DBFile).filter(
-        models.DBFile.filename == file.filename,
-        models.DBFile.parent_id == parent_id
-    ).first()
-    
-    if existing_file:
-         db.delete(existing_file)
-         db.commit()
-         
-    new_file = models.DBFile(
-        filename=file.filename,
-        content_type=file.content_type,
-        size=len(request_object_content),
-        data=request_object_content,
-        parent_id=parent_id,
-        is_folder=False
+    if request.headers.get("content-type", "").split(";")[0].strip() != resumable.CHUNK_MEDIA_TYPE:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Send the data as {resumable.CHUNK_MEDIA_TYPE}"
+        )
+    session = await get_upload_session(db, upload_id)
+    offset, length = session.received, session.length
+    if upload_offset != offset:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload is at offset {offset}",
+            headers=upload_headers(session)
+        )
+    # Nothing may hold the connection while the body streams in
+    await db.rollback()
+
+    too_large = None
+    writer = resumable.PartWriter(upload_id, offset, length)
+    try:
+        async with writer:
+            async for chunk in request.stream():
+                await writer.write(chunk)
+    except ClientDisconnect:
+        pass  # Whatever arrived is kept, the client resumes from there
+    except storage.UploadTooLarge as e:
+        too_large = e
+    except resumable.UploadBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Upload data is gone, start over")
+
+    # The data is synced to disk before the offset moves past it
+    result = await db.execute(
+        update(models.UploadSession)
+        .where(models.UploadSession.id == upload_id, models.UploadSession.received == offset)
+        .values(received=writer.received, expires_at=resumable.expires_at())
+    )
+    await db.commit()
+    if result.rowcount == 0:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload was written concurrently")
+    if too_large is not None:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(too_large))
+    return Response(
+        status_code=status.HTTP_204_NO_CONTENT,
+        headers={"Upload-Offset": str(writer.received), "Cache-Control": "no-store"}
     )
-    db.add(new_file)
-    db.commit()
-    
-    return {"filename": file.filename}
 
-@app.delete("/files/delete/{item_id}")
-async def delete_item(item_id: int, db: Session = Depends(get_db)):
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, db: AsyncSession = Depends(get_db)):
+    session = await get_upload_session(db, upload_id)
+    if session.received != session.length:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload is incomplete, {session.received} of {session.length} bytes received",
+            headers=upload_headers(session)
+        )
+    filename, content_type, parent_id, size = session.filename, session.content_type, session.parent_id, session.length
+    if parent_id is not None:
+        parent = await db.get(models.DBFile, parent_id)
+        if parent is None or not parent.is_folder:
+            raise HTTPException(status_code=404, detail="Target folder not found")
+    try:
+        stored, content_hash = await run_in_threadpool(resumable.finish_part, upload_id, size)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Upload data is gone, start over")
+    except resumable.UploadBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    if content_hash is None:
+        # The part lost data after its offset was recorded, resume from what is there
+        await db.execute(
+            update(models.UploadSession)
+            .where(models.UploadSession.id == upload_id)
+            .values(received=stored, expires_at=resumable.expires_at())
+        )
+        await db.commit()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload data is incomplete, {stored} of {size} bytes stored",
+            headers={"Upload-Offset": str(stored), "Upload-Length": str(size), "Cache-Control": "no-store"}
+        )
+
+    # The session goes away in the transaction that creates the file
+    await db.delete(session)
+    file_id, job_ids = await save_file(
+        db, resumable.part_path(upload_id), size, content_hash, filename, content_type, parent_id
+    )
+    return {"filename": filename, "id": file_id, "jobs": job_ids}
+
+@app.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def cancel_upload(upload_id: str, db: AsyncSession = Depends(get_db)):
+    session = await get_upload_session(db, upload_id)
+    await db.delete(session)
+    await db.commit()
+    await run_in_threadpool(resumable.discard_part, upload_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+# Post-upload processing
+class JobResponse(BaseModel):
+    id: int
+    kind: str
+    file_id: Optional[int]
+    status: str
+    attempts: int
+    max_attempts: int
+    result: Optional[str]
+    last_error: Optional[str]
+
+    class Config:
+        from_attributes = True
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: int, db: AsyncSession = Depends(get_db)):
+    job = await db.get(models.Job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/files/{file_id}/jobs", response_model=List[JobResponse])
+async def get_file_jobs(file_id: int, db: AsyncSession = Depends(get_db)):
+    return (await db.scalars(
+        select(models.Job).where(models.Job.file_id == file_id).order_by(models.Job.id)
+    )).all()
+
+# Search
+@app.get("/files/search", response_model=List[SearchResult])
+async def search_files(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db)
+):
+    hits = await search.search(db, q, limit)
+    if not hits:
+        return FastJSONResponse([])
+    found = {
+        f.id: f for f in (await db.execute(
+            select(models.DBFile.id, models.DBFile.filename, models.DBFile.size,
+                   models.DBFile.content_type, models.DBFile.is_folder, models.DBFile.parent_id)
+            .where(models.DBFile.id.in_([hit.id for hit in hits]))
+        )).all()
+    }
+    results = []
+    for hit in hits:
+        f = found.get(hit.id)
+        if f is None:
+            continue
+        results.append(SearchResult(
+            f.id, f.filename, f.size, "folder" if f.is_folder else f.content_type,
+            f.is_folder, f.parent_id, hit.snippet
+        ))
+    # Returned as a response, FastAPI's jsonable_encoder pass is skipped
+    return FastJSONResponse(results)
+
+# Bulk upload. BULK_MAX_ENTRIES counts uploaded files and archive members
+# alike, BULK_MAX_TOTAL_SIZE the bytes spooled for one request after extraction
+BULK_MAX_ENTRIES = int(os.getenv("BULK_MAX_ENTRIES", 10000))
+BULK_MAX_TOTAL_SIZE = int(os.getenv("BULK_MAX_TOTAL_SIZE", 2 * 1024 * 1024 * 1024))
+
+def parent_in(column, parent_ids):
+    # IN () never matches NULL, so the root needs its own IS NULL test
+    ids = [p for p in parent_ids if p is not None]
+    clauses = [column.in_(ids)] if ids else []
+    if None in parent_ids:
+        clauses.append(column.is_(None))
+    return or_(*clauses)
+
+async def ensure_folders(db, parent_id, paths):
+    """Map folder paths (tuples of names below parent_id) to folder ids.
+
+    Existing folders are reused, missing ones are inserted one batch per depth.
+    """
+    folder_ids = {(): parent_id}
+    for depth in range(1, max(map(len, paths), default=0) + 1):
+        level = sorted({path[:depth] for path in paths if len(path) >= depth})
+        parents = {folder_ids[path[:-1]] for path in level}
+        existing = {
+            (row.parent_id, row.filename): row
+            for row in (await db.execute(
+                select(models.DBFile.id, models.DBFile.parent_id, models.DBFile.filename, models.DBFile.is_folder)
+                .where(
+                    parent_in(models.DBFile.parent_id, parents),
+                    models.DBFile.filename.in_({path[-1] for path in level})
+                )
+            )).all()
+        }
+        new_folders = {}
+        for path in level:
+            key = (folder_ids[path[:-1]], path[-1])
+            row = existing.get(key)
+            if row is None:
+                new_folders[path] = models.DBFile(
+                    filename=path[-1],
+                    content_type="application/x-directory",
+                    size=0,
+                    is_folder=True,
+                    parent_id=key[0]
+                )
+            elif row.is_folder:
+                folder_ids[path] = row.id
+            else:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"A file named {'/'.join(path)} is in the way of a folder"
+                )
+        if new_folders:
+            db.add_all(new_folders.values())
+            await db.flush()  # One batched INSERT ... RETURNING for the whole level
+            for path, folder in new_folders.items():
+                folder_ids[path] = folder.id
+                await search.index_file(db, folder.id, folder.filename)
+            for folder_parent in {folder.parent_id for folder in new_folders.values()}:
+                await bump_folder_version(db, folder_parent)
+    return folder_ids
+
+async def read_bulk_form(request):
+    """files, parent_id and extract_archives of a bulk upload form.
+
+    Parsed by upload_stream as the body arrives, so BULK_MAX_TOTAL_SIZE and
+    BULK_MAX_ENTRIES hold before the body is on disk, and every file is
+    written once. The files are spooled, the caller owns the spools.
+    """
+    form = await read_streamed_form(
+        request, file_field="files", max_files=BULK_MAX_ENTRIES, max_total=BULK_MAX_TOTAL_SIZE
+    )
+    try:
+        parent_id = form_parent_id(form.fields.get("parent_id"))
+        if not form.files:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="No files in the upload")
+    except HTTPException:
+        upload_stream.discard_files(form.files)
+        raise
+    extract_archives = form.fields.get("extract_archives", "").lower() in ("1", "true", "on", "yes")
+    return form.files, parent_id, extract_archives
+
+@app.post("/files/upload/bulk", openapi_extra=form_body(
+    files={"type": "array", "items": BINARY}, parent_id={"type": "integer"}, extract_archives={"type": "boolean"}
+))
+async def upload_files_bulk(request: Request, db: AsyncSession = Depends(get_db)):
+    files, parent_id, extract_archives = await read_bulk_form(request)
+    return await save_bulk_upload(db, files, parent_id, extract_archives)
+
+def extract_spooled_archive(upload, spent):
+    # Blocking. The archive's own spool goes once its entries are out
+    try:
+        with open(upload.spool_path, "rb") as f:
+            return archives.spool_archive(
+                f, upload.filename, BULK_MAX_ENTRIES, storage.MAX_UPLOAD_SIZE, BULK_MAX_TOTAL_SIZE, spent
+            )
+    finally:
+        storage.discard_spool(upload.spool_path)
+
+def discard_unsaved(entries, files):
+    # Spooled entries, and uploaded files not yet made entries
+    archives.discard_entries(entries.values())
+    upload_stream.discard_files(files)
+
+async def save_bulk_upload(db, files, parent_id, extract_archives):
+    # Entries keyed by target path (last one wins), archives extracted one at
+    # a time. Takes over the spools of files
+    entries = {}
+    spent = 0
     try:
-        # Recursive delete function
-        def delete_recursive(id):
-            # Fetch children first
-            children = db.query(models.DBFile).filter(models.DBFile.parent_id == id).all()
-            for child in children:
-                delete_recursive(child.id)
-            
-            # Fetch item again to ensure it's attached/available
-            item = db.query(models.DBFile).filter(models.DBFile.id == id).first()
-            if item:
-                db.delete(item)
-                db.flush() # Force delete execution to respect order
-
-        item = db.query(models.DBFile).filter(models.DBFile.id == item_id).first()
-        if item:
-            # If it's a folder, delete children content first
-            if item.is_folder:
-                delete_recursive(item.id)
+        for index, upload in enumerate(files):
+            if extract_archives and archives.is_archive(upload.filename):
+                spooled = await run_in_threadpool(extract_spooled_archive, upload, spent)
             else:
-                db.delete(item)
-                
-            db.commit()
-            return {"message": "Item deleted"}
-        raise HTTPException(status_code=404, detail="Item not found")
+                spooled = [archives.SpooledEntry(
+                    (), upload.filename, upload.content_type, upload.spool_path, upload.size, upload.content_hash
+                )]
+            spent += sum(entry.size for entry in spooled)
+            for entry in spooled:
+                previous = entries.pop((entry.folder, entry.filename), None)
+                if previous:
+                    storage.discard_spool(previous.spool_path)
+                entries[(entry.folder, entry.filename)] = entry
+            if len(entries) > BULK_MAX_ENTRIES:
+                raise archives.InvalidArchive(f"More than {BULK_MAX_ENTRIES} files in one upload")
+    except storage.UploadTooLarge as e:
+        discard_unsaved(entries, files[index:])
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except archives.InvalidArchive as e:
+        discard_unsaved(entries, files[index:])
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except BaseException:
+        discard_unsaved(entries, files[index:])
+        raise
+
+    # Metadata for the whole batch in one transaction with batched statements
+    try:
+        folder_ids = await ensure_folders(db, parent_id, {entry.folder for entry in entries.values()})
+        targets = {(folder_ids[entry.folder], entry.filename): entry for entry in entries.values()}
+
+        # Same-name files are replaced, as with single uploads
+        replaced = [
+            row for row in (await db.execute(
+                select(models.DBFile.id, models.DBFile.parent_id, models.DBFile.filename,
+                       models.DBFile.is_folder, models.DBFile.content_hash)
+                .where(
+                    parent_in(models.DBFile.parent_id, {key[0] for key in targets}),
+                    models.DBFile.filename.in_({key[1] for key in targets})
+                )
+            )).all()
+            if (row.parent_id, row.filename) in targets
+        ]
+        for row in replaced:
+            if row.is_folder:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"A folder named {row.filename} already exists"
+                )
+        released = await storage.release_blobs(db, [row.content_hash for row in replaced])
+        if replaced:
+            replaced_ids = [row.id for row in replaced]
+            await search.unindex(db, replaced_ids)
+            await db.execute(
+                delete(models.DBFile).where(models.DBFile.id.in_(replaced_ids))
+            )
+
+        counts = {}
+        for entry in entries.values():
+            counts[entry.content_hash] = counts.get(entry.content_hash, 0) + 1
+        # Content not stored yet is compressed once, duplicates reuse that blob
+        encodings = await storage.blob_encodings(db, counts)
+        first_seen = {}
+        for entry in entries.values():
+            if entry.content_hash not in encodings:
+                first_seen.setdefault(entry.content_hash, entry)
+
+        def compress_new():
+            new_blobs = {}
+            for content_hash, entry in first_seen.items():
+                entry.spool_path, encoding, stored_size = storage.compress_spool(
+                    entry.spool_path, entry.size, entry.content_type
+                )
+                new_blobs[content_hash] = (entry.size, encoding, stored_size)
+            return new_blobs
+
+        new_blobs = await run_in_threadpool(compress_new)
+        # Spools of content already stored are raw, written only if its copy went away
+        spooled = {entry.content_hash: (entry.size, None, entry.size) for entry in entries.values()}
+        spooled.update(new_blobs)
+        encodings = await storage.acquire_blob_counts(db, counts, spooled)
+
+        def place_all():
+            # First occurrences go first, later duplicates then find the blob in place
+            for content_hash, entry in first_seen.items():
+                encodings[content_hash] = storage.place_blob(
+                    entry.spool_path, content_hash, new_blobs[content_hash][1], encodings[content_hash]
+                )
+            for entry in entries.values():
+                if first_seen.get(entry.content_hash) is not entry:
+                    encodings[entry.content_hash] = storage.place_blob(
+                        entry.spool_path, entry.content_hash, None, encodings[entry.content_hash]
+                    )
+
+        await run_in_threadpool(place_all)
+
+        new_ids = (await db.scalars(insert(models.DBFile).returning(models.DBFile.id), [
+            {
+                "filename": filename,
+                "content_type": entry.content_type,
+                "size": entry.size,
+                "content_hash": entry.content_hash,
+                "content_encoding": encodings[entry.content_hash],
+                "parent_id": folder_id,
+                "is_folder": False,
+            }
+            for (folder_id, filename), entry in targets.items()
+        ])).all()
+        for folder_id in {key[0] for key in targets}:
+            await bump_folder_version(db, folder_id)
+        job_ids = await jobs.enqueue(db, processing.POST_UPLOAD_JOBS, new_ids)
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        archives.discard_entries(entries.values())
+        raise
+
+    await storage.collect_blobs(db, released)
+    jobs.submit(job_ids)
+
+    return {
+        "uploaded": len(targets),
+        "jobs": len(job_ids),
+        "folders": len(folder_ids) - 1,
+        "files": ["/".join(entry.folder + (entry.filename,)) for entry in entries.values()]
+    }
+
+def subtree_ids(item_id):
+    # Recursive CTE over parent_id, the item itself plus all its descendants
+    subtree = select(models.DBFile.id).where(
+        models.DBFile.id == item_id
+    ).cte(name="subtree", recursive=True)
+    subtree = subtree.union_all(
+        select(models.DBFile.id).where(models.DBFile.parent_id == subtree.c.id)
+    )
+    return select(subtree.c.id)
+
+@app.delete("/files/delete/{item_id}")
+async def delete_item(item_id: int, db: AsyncSession = Depends(get_db)):
+    try:
+        item = (await db.execute(
+            select(models.DBFile.id, models.DBFile.parent_id)
+            .where(models.DBFile.id == item_id)
+        )).first()
+        if not item:
+            raise HTTPException(status_code=404, detail="Item not found")
+
+        # Whole subtree in a fixed number of statements, file bodies never loaded
+        released = await storage.release_blob_counts(db, dict((await db.execute(
+            select(models.DBFile.content_hash, func.count())
+            .where(
+                models.DBFile.id.in_(subtree_ids(item_id)),
+                models.DBFile.content_hash.isnot(None)
+            )
+            .group_by(models.DBFile.content_hash)
+        )).all()))
+        await search.unindex(db, subtree_ids(item_id))
+        # Listings of removed folders must not revalidate as unchanged
+        await bump_subtree_versions(db, item_id)
+        await db.execute(
+            delete(models.DBFile)
+            .where(models.DBFile.id.in_(subtree_ids(item_id)))
+            .execution_options(synchronize_session=False)
+        )
+        await bump_folder_version(db, item.parent_id)
+        await db.commit()
+        await storage.collect_blobs(db, released)
+        return {"message": "Item deleted"}
+    except HTTPException:
+        raise
     except Exception as e:
+        await db.rollback()
         print(f"Error deleting item {item_id}: {str(e)}")
         # Print full traceback if possible or ensure it's visible
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/files/download/{item_id}")
-async def download_file(item_id: int, db: Session = Depends(get_db)):
-    db_file = db.query(models.DBFile).filter(models.DBFile.id == item_id).first()
+def attachment(filename):
+    # RFC 6266 filename* form, so non-ASCII names survive
+    return f"attachment; filename*=utf-8''{quote(filename)}"
+
+def legacy_chunks(item_id):
+    # Bodies stored inline before the blob store, read with a short sync session.
+    # migrate_blobs.py may have moved the row since its metadata was read,
+    # its body is then in the blob store
+    def open_chunks():
+        with SessionLocal() as session:
+            row = session.execute(
+                select(models.DBFile.data, models.DBFile.content_hash, models.DBFile.content_encoding)
+                .where(models.DBFile.id == item_id)
+            ).first()
+        if row is not None and row.data is None and row.content_hash is not None:
+            yield from storage.blob_store.iter(row.content_hash, row.content_encoding)
+        else:
+            yield (row.data if row is not None else None) or b""
+    return open_chunks
+
+@app.get("/folders/{folder_id}/archive")
+async def download_folder_archive(
+    folder_id: int,
+    format: Literal["zip", "tar"] = "zip",
+    db: AsyncSession = Depends(get_db)
+):
+    folder = await db.get(models.DBFile, folder_id)
+    if not folder or not folder.is_folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+    # The whole subtree in one recursive query, metadata only
+    columns = (
+        models.DBFile.id, models.DBFile.parent_id, models.DBFile.filename, models.DBFile.is_folder,
+        models.DBFile.size, models.DBFile.content_type, models.DBFile.content_hash,
+        models.DBFile.content_encoding, models.DBFile.updated_at,
+    )
+    tree = select(*columns).where(models.DBFile.id == folder_id).cte(name="tree", recursive=True)
+    tree = tree.union_all(select(*columns).where(models.DBFile.parent_id == tree.c.id))
+    tree_rows = (await db.execute(select(tree))).all()
+
+    # Archive paths are joined here from cleaned names, never from raw ones
+    by_id = {row.id: row for row in tree_rows}
+    paths = {}
+    def archive_path(row):
+        if row.id not in paths:
+            name = archives.safe_member_name(row.filename)
+            paths[row.id] = name if row.id == folder_id else f"{archive_path(by_id[row.parent_id])}/{name}"
+        return paths[row.id]
+    rows = sorted(tree_rows, key=archive_path)
+
+    members = []
+    for row in rows:
+        if row.content_hash is not None:
+            open_chunks = partial(storage.blob_store.iter, row.content_hash, row.content_encoding)
+        else:
+            open_chunks = legacy_chunks(row.id)
+        members.append(archives.ArchiveMember(
+            arcname=paths[row.id] + "/" if row.is_folder else paths[row.id],
+            is_folder=row.is_folder,
+            size=row.size or 0,
+            content_type=row.content_type,
+            open_chunks=None if row.is_folder else open_chunks,
+            mtime=row.updated_at.replace(tzinfo=timezone.utc).timestamp() if row.updated_at else None
+        ))
+
+    # Generated while it is sent, memory stays at about one chunk per request
+    if format == "tar":
+        body, media_type = archives.stream_tar(members), "application/x-tar"
+    else:
+        body, media_type = archives.stream_zip(members), "application/zip"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": attachment(f"{folder.filename}.{format}")}
+    )
+
+@app.get("/files/{item_id}/preview")
+async def preview_file(
+    request: Request,
+    item_id: int,
+    w: int = Query(previews.PREVIEW_DEFAULT_WIDTH, ge=16, le=4096),
+    db: AsyncSession = Depends(get_db)
+):
+    f = (await db.execute(
+        select(models.DBFile.content_hash, models.DBFile.content_encoding, models.DBFile.content_type)
+        .where(models.DBFile.id == item_id, models.DBFile.is_folder.is_(False))
+    )).first()
+    if not f or not f.content_hash or not previews.is_previewable(f.content_type):
+        raise HTTPException(status_code=404, detail="No preview available")
+    width = previews.snap_width(w)
+    # Same content and width, same preview
+    etag = http_cache.strong_etag(f"{f.content_hash[:32]}-{width}")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if http_cache.is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    data = await previews.get_preview(f.content_hash, f.content_encoding, f.content_type, width)
+    if not data:
+        raise HTTPException(status_code=404, detail="No preview available")
+    return Response(data, media_type=previews.MEDIA_TYPE, headers=headers)
+
+@app.api_route("/files/download/{item_id}", methods=["GET", "HEAD"])
+async def download_file(request: Request, item_id: int, db: AsyncSession = Depends(get_db)):
+    db_file = await db.get(models.DBFile, item_id)
     if db_file and not db_file.is_folder:
+        encoding = db_file.content_encoding
+        # Compressed blobs go out as stored when the client accepts the encoding
+        send_encoded = encoding is not None and http_cache.accepts_encoding(request, encoding)
+        etag = file_etag(db_file, encoding if send_encoded else None)
+        headers = {"Cache-Control": "no-cache"}
+        if etag:
+            headers["ETag"] = etag
+        if encoding:
+            headers["Vary"] = "Accept-Encoding"
+        if send_encoded:
+            headers["Content-Encoding"] = encoding
+        if db_file.updated_at:
+            headers["Last-Modified"] = http_cache.http_date(db_file.updated_at)
+        # Answered from metadata alone, the blob is never opened
+        if http_cache.is_not_modified(request, etag, db_file.updated_at):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        path = None
+        if db_file.content_hash and (send_encoded or encoding is None):
+            path = storage.blob_store.path(db_file.content_hash, encoding)
+        if path is not None:
+            # FileResponse (Starlette >= 0.39) answers Range / If-Range with 206,
+            # multipart for several ranges. It reads the file in chunks; only a
+            # server with the pathsend extension (not uvicorn) would sendfile it
+            return FileResponse(
+                path,
+                media_type=db_file.content_type,
+                filename=db_file.filename,
+                headers=headers
+            )
+        if db_file.content_hash is not None:
+            # Decoded on the fly, only for clients without support for the encoding
+            body = storage.blob_store.iter(db_file.content_hash, encoding)
+        else:
+            # Uploaded before on-disk storage, the deferred column is loaded only here
+            body = legacy_chunks(item_id)()
+        # One range is served by decoding up to its end and dropping what
+        # precedes it, so seeking costs time proportional to the offset
+        size = db_file.size or 0
+        headers["Accept-Ranges"] = "bytes"
+        headers["Content-Disposition"] = attachment(db_file.filename)
+        try:
+            byte_range = http_cache.single_range(request, size, etag, db_file.updated_at)
+        except http_cache.RangeNotSatisfiable:
+            return Response(
+                status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE,
+                headers={**headers, "Content-Range": f"bytes */{size}"}
+            )
+        if byte_range is None:
+            headers["Content-Length"] = str(size)
+            return StreamingResponse(body, media_type=db_file.content_type, headers=headers)
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
         return StreamingResponse(
-            io.BytesIO(db_file.data), 
+            storage.slice_chunks(body, start, end - start + 1),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
             media_type=db_file.content_type,
-            headers={"Content-Disposition": f"attachment; filename={db_file.filename}"}
+            headers=headers
         )
     raise HTTPException(status_code=404, detail="File not found or is a folder")
 
@@ -0,0 +1,274 @@
+"""Move file bodies stored inline in files.data to the blob store, online.
+
+Rows are streamed in id order with a server-side cursor (yield_per) and
+taken in batches bounded by row count and bytes, so memory stays flat
+however big the table is. Every body is spooled, hashed, stored (compressed
+and deduplicated like uploads) and read back to verify its checksum. Only
+then does one transaction per batch point the rows at their blobs and null
+out files.data. The app reads either form throughout (dual read), so it can
+keep serving while this runs.
+
+Nulling files.data is final, the blob store is the only copy afterwards.
+It must live on durable disk shared with every app instance (STORAGE_DIR,
+BLOB_STORE=filesystem is the only store so far). Never run this where the
+disk is ephemeral, as on a serverless deployment (Vercel): the bodies would
+be gone with the instance. So the script wants STORAGE_DIR set explicitly,
+refuses to run on Vercel and only writes with --confirm:
+
+    python migrate_blobs.py --status
+    STORAGE_DIR=/srv/mechtron/storage python migrate_blobs.py --confirm --max-rate 20 --pause 0.5
+    STORAGE_DIR=/srv/mechtron/storage python migrate_blobs.py --confirm --restart   # rescan skipped rows
+
+Progress is saved after each batch, an interrupted run continues where it
+stopped.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+import uuid
+
+from sqlalchemy import func, select, update
+
+import migrations
+import models
+import storage
+from database import get_engine, upsert
+
+PROGRESS_PATH = os.path.join(storage.STORAGE_DIR, "blob-migration.json")
+
+files = models.DBFile.__table__
+blobs = models.Blob.__table__
+
+
+def load_progress():
+    try:
+        with open(PROGRESS_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"last_id": 0, "migrated": 0, "bytes": 0, "skipped": []}
+
+
+def save_progress(progress):
+    os.makedirs(storage.STORAGE_DIR, exist_ok=True)
+    tmp_path = f"{PROGRESS_PATH}.{uuid.uuid4().hex}.part"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, PROGRESS_PATH)
+
+
+def inline_rows():
+    return (files.c.content_hash.is_(None), files.c.data.is_not(None))
+
+
+def status(engine):
+    with engine.connect() as conn:
+        count, total = conn.execute(
+            select(func.count(), func.coalesce(func.sum(func.length(files.c.data)), 0)).where(*inline_rows())
+        ).one()
+    progress = load_progress()
+    print(f"{count} files with {total} bytes still inline")
+    print(f"migrated so far: {progress['migrated']} files, {progress['bytes']} bytes, "
+          f"next id {progress['last_id'] + 1}, skipped {len(progress['skipped'])}")
+
+
+def verify(content_hash, encoding, size):
+    # Read the stored copy back through the decoder, as downloads will
+    digest = hashlib.sha256()
+    stored = 0
+    for chunk in storage.blob_store.iter(content_hash, encoding):
+        digest.update(chunk)
+        stored += len(chunk)
+    return stored == size and digest.hexdigest() == content_hash
+
+
+def spool_batch(engine, after_id, batch_rows, batch_bytes, fetch_rows):
+    """Spool the next batch of inline bodies to disk.
+
+    Returns [(id, spool_path, size, hash, content_type)] and the last id
+    seen. The cursor is closed before anything gets written to the database.
+    """
+    stmt = (
+        select(files.c.id, files.c.content_type, files.c.data)
+        .where(files.c.id > after_id, *inline_rows())
+        .order_by(files.c.id)
+    )
+    entries = []
+    total = 0
+    last_id = after_id
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=fetch_rows).execute(stmt)
+        try:
+            for row in result:
+                spool_path, size, content_hash = storage.spool_stream(io.BytesIO(row.data), max_size=len(row.data))
+                entries.append((row.id, spool_path, size, content_hash, row.content_type))
+                last_id = row.id
+                total += size
+                if len(entries) >= batch_rows or total >= batch_bytes:
+                    break
+        except BaseException:
+            for entry in entries:
+                storage.discard_spool(entry[1])
+            raise
+        finally:
+            result.close()
+    return entries, last_id
+
+
+def store_batch(engine, entries, verified):
+    """Store and verify the spooled bodies, then switch their rows over.
+
+    Returns (ids migrated, bytes migrated, ids skipped).
+    """
+    with engine.connect() as conn:
+        known = dict(conn.execute(
+            select(blobs.c.hash, blobs.c.encoding).where(blobs.c.hash.in_({e[3] for e in entries}))
+        ).all())
+
+    new_blobs = {}  # hash -> (size, encoding, stored_size)
+    good = []
+    skipped = []
+    for file_id, spool_path, size, content_hash, content_type in entries:
+        if content_hash in known or content_hash in new_blobs:
+            storage.discard_spool(spool_path)
+            encoding = known[content_hash] if content_hash in known else new_blobs[content_hash][1]
+        else:
+            spool_path, encoding, stored_size = storage.compress_spool(spool_path, size, content_type)
+            storage.blob_store.put(spool_path, content_hash, encoding)
+            new_blobs[content_hash] = (size, encoding, stored_size)
+        if content_hash not in verified:
+            if not verify(content_hash, encoding, size):
+                print(f"File {file_id}: stored copy of {content_hash} does not match, left inline")
+                skipped.append(file_id)
+                continue
+            verified.add(content_hash)
+        good.append((file_id, size, content_hash, encoding))
+
+    migrated = []
+    counts = {}
+    sizes = {}
+    encodings = {}
+    with engine.begin() as conn:
+        for file_id, size, content_hash, encoding in good:
+            # Rows replaced or deleted by the app meanwhile are left alone
+            result = conn.execute(
+                update(files)
+                .where(files.c.id == file_id, files.c.content_hash.is_(None))
+                .values(content_hash=content_hash, content_encoding=encoding, data=None)
+            )
+            if result.rowcount:
+                migrated.append((file_id, size))
+                counts[content_hash] = counts.get(content_hash, 0) + 1
+                sizes[content_hash] = size
+                encodings[content_hash] = encoding
+        # Upserts, uploads of the same content may create the row meanwhile
+        hashes = sorted(counts)
+        for start in range(0, len(hashes), storage.ACQUIRE_BATCH):
+            stmt = upsert(conn, blobs).values([
+                {"hash": h, "size": sizes[h], "refcount": counts[h], "encoding": encodings[h],
+                 "stored_size": new_blobs[h][2] if h in new_blobs else sizes[h]}
+                for h in hashes[start:start + storage.ACQUIRE_BATCH]
+            ])
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=[blobs.c.hash],
+                set_={"refcount": blobs.c.refcount + stmt.excluded.refcount}
+            ))
+    # Bytes stored for rows that went away are reused if the content comes back
+    return [file_id for file_id, _ in migrated], sum(size for _, size in migrated), skipped
+
+
+def run(engine, args):
+    progress = load_progress()
+    if args.restart:
+        progress["last_id"] = 0
+        progress["skipped"] = []
+    verified = set()
+    started = time.monotonic()
+    moved_bytes = 0
+    moved_rows = 0
+
+    while args.limit is None or moved_rows < args.limit:
+        batch_rows = args.batch_rows if args.limit is None else min(args.batch_rows, args.limit - moved_rows)
+        entries, last_id = spool_batch(engine, progress["last_id"], batch_rows, args.batch_bytes, args.fetch_rows)
+        if not entries:
+            break
+        try:
+            migrated, size, skipped = store_batch(engine, entries, verified)
+        finally:
+            for entry in entries:
+                storage.discard_spool(entry[1])
+        progress["last_id"] = last_id
+        progress["migrated"] += len(migrated)
+        progress["bytes"] += size
+        progress["skipped"] += skipped
+        save_progress(progress)
+        moved_rows += len(migrated)
+        moved_bytes += size
+        print(f"up to id {last_id}: {moved_rows} files, {moved_bytes} bytes moved")
+
+        # Throttle, so the database and the disk keep room for live traffic
+        if args.max_rate:
+            ahead = moved_bytes / (args.max_rate * 1024 * 1024) - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+        if args.pause:
+            time.sleep(args.pause)
+
+    print(f"done: {moved_rows} files, {moved_bytes} bytes moved in {time.monotonic() - started:.1f} s")
+    if progress["skipped"]:
+        print(f"{len(progress['skipped'])} files left inline, see {PROGRESS_PATH}")
+
+
+def durability_problems():
+    problems = []
+    if storage.EPHEMERAL_DISK:
+        problems.append("this is a Vercel deployment, its disk does not outlive the instance")
+    if not os.getenv("STORAGE_DIR"):
+        problems.append(
+            f"STORAGE_DIR is not set, the default {storage.STORAGE_DIR} is relative to the working directory"
+        )
+    if storage.BLOB_STORE != "filesystem":
+        problems.append(f"BLOB_STORE={storage.BLOB_STORE} is not a store this script knows")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--status", action="store_true", help="Show what is left and exit")
+    parser.add_argument("--batch-rows", type=int, default=200, help="Rows per transaction")
+    parser.add_argument("--batch-bytes", type=int, default=64 * 1024 * 1024, help="Body bytes per transaction")
+    parser.add_argument("--fetch-rows", type=int, default=8, help="Rows fetched from the cursor at a time")
+    parser.add_argument("--max-rate", type=float, default=0, help="MB per second, 0 for no limit")
+    parser.add_argument("--pause", type=float, default=0, help="Seconds to sleep between batches")
+    parser.add_argument("--limit", type=int, help="Stop after this many files")
+    parser.add_argument("--restart", action="store_true", help="Start over from the first id")
+    parser.add_argument(
+        "--confirm", action="store_true",
+        help="STORAGE_DIR is durable and shared, inline bodies may be dropped once copied there"
+    )
+    args = parser.parse_args()
+
+    if not args.status:
+        problems = durability_problems()
+        for problem in problems:
+            print(f"Refusing to migrate: {problem}")
+        if not problems and not args.confirm:
+            print(f"Blobs would be written to {os.path.abspath(storage.STORAGE_DIR)} and files.data "
+                  "nulled afterwards. Rerun with --confirm if that disk is durable.")
+        if problems or not args.confirm:
+            sys.exit(2)
+
+    # The blob columns must exist, same switch as the app (SCHEMA_MIGRATIONS)
+    migrations.auto_migrate()
+    engine = get_engine()
+    if args.status:
+        status(engine)
+    else:
+        run(engine, args)
+
+
+if __name__ == "__main__":
+    main()
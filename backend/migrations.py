@@ -0,0 +1,246 @@
+"""Versioned schema migrations.
+
+Every migration runs once per database, in version order, in its own
+transaction, and is recorded in schema_migrations. Append new ones to the
+end, never change one that has been released:
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --status
+
+With SCHEMA_MIGRATIONS=auto (the default) the app applies pending
+migrations itself before its first database session. Set it to "off" when
+deploys run this script instead, a cold start then only pays for the
+queries it actually serves.
+"""
+import argparse
+import os
+import sys
+import warnings
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable
+
+try:
+    import fcntl
+except ImportError:  # Windows, local development only
+    fcntl = None
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, insert, select
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+import models
+import search
+from database import Base, get_engine
+
+SCHEMA_MIGRATIONS = os.getenv("SCHEMA_MIGRATIONS", "auto")
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), default=models.utcnow, nullable=False),
+)
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    apply: Callable
+
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(func):
+        MIGRATIONS.append(Migration(version, description, func))
+        return func
+    return register
+
+
+# Helpers. A fresh database gets the current models from the baseline, so
+# later migrations must accept finding their change already in place
+
+def add_missing_columns(conn):
+    # Columns and indexes of the models that existing tables lack (new columns are all nullable)
+    inspector = inspect(conn)
+    # Reflection skips the expression indexes with a warning, they are left
+    # to the migrations that create them
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "Skipped unsupported reflection of expression-based index")
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.exec_driver_sql(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                )
+            for index in table.indexes:
+                if any(not isinstance(e, Column) for e in index.expressions):
+                    continue
+                try:
+                    with conn.begin_nested():
+                        index.create(conn, checkfirst=True)
+                except Exception as e:
+                    # e.g. duplicate names in a folder predating the unique index
+                    print(f"Could not create index {index.name}: {e}")
+
+
+# Migrations
+
+@migration(1, "Baseline: model tables, plus columns and indexes older databases lack")
+def baseline(conn):
+    # Databases created before migrations existed are brought up to date here
+    Base.metadata.create_all(conn)
+    add_missing_columns(conn)
+
+
+@migration(2, "Full-text search index")
+def search_index(conn):
+    search.ensure_search_schema(conn)
+
+
+@migration(3, "Resumable upload sessions")
+def upload_sessions(conn):
+    models.UploadSession.__table__.create(conn, checkfirst=True)
+
+
+@migration(4, "Timestamps with time zone")
+def timestamps_with_time_zone(conn):
+    # models.utcnow() is aware, asyncpg refuses it for a timestamp without
+    # time zone. The stored values are naive UTC. SQLite has no such type
+    if conn.dialect.name != "postgresql":
+        return
+    inspector = inspect(conn)
+    for table in [*Base.metadata.sorted_tables, schema_migrations]:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {col["name"]: col["type"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if not isinstance(column.type, DateTime) or column.name not in existing:
+                continue
+            if getattr(existing[column.name], "timezone", False):
+                continue
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ALTER COLUMN {column.name} "
+                f"TYPE TIMESTAMP WITH TIME ZONE USING {column.name} AT TIME ZONE 'UTC'"
+            )
+
+
+@migration(5, "Type sort index over COALESCE(content_type, '')")
+def type_sort_index(conn):
+    # Was on the bare column, the listing now sorts by models.content_type_key.
+    # Rebuilt on a fresh database too, it is empty there
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_files_parent_type")
+    index = next(i for i in models.DBFile.__table__.indexes if i.name == "ix_files_parent_type")
+    index.create(conn)
+
+
+# Arbitrary, shared by every process migrating the same Postgres database
+ADVISORY_LOCK_ID = 80421
+
+
+@contextmanager
+def migration_lock(bind):
+    """Serialises migration runners, so workers starting together apply each migration once."""
+    if bind.dialect.name == "postgresql":
+        with bind.connect() as conn:
+            conn.exec_driver_sql(f"SELECT pg_advisory_lock({ADVISORY_LOCK_ID})")
+            try:
+                yield
+            finally:
+                conn.exec_driver_sql(f"SELECT pg_advisory_unlock({ADVISORY_LOCK_ID})")
+                conn.commit()
+        return
+    database = bind.url.database if bind.dialect.name == "sqlite" else None
+    if fcntl is None or not database or database == ":memory:":
+        yield
+        return
+    # SQLite runs DDL outside of any transaction, a lock file next to the
+    # database keeps two runners from creating the same table
+    with open(f"{database}.migrate-lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def already_applied(error):
+    # A runner without the lock (an older release) got there first
+    if isinstance(error, IntegrityError):
+        return True
+    message = str(error.orig).lower()
+    return "already exists" in message or "duplicate column" in message
+
+
+def applied_versions(conn):
+    schema_migrations.create(conn, checkfirst=True)
+    return set(conn.scalars(select(schema_migrations.c.version)))
+
+
+def _pending(bind):
+    try:
+        with bind.begin() as conn:
+            applied = applied_versions(conn)
+    except DBAPIError as e:
+        if not already_applied(e):
+            raise
+        # schema_migrations was just created by a runner without the lock
+        with bind.begin() as conn:
+            applied = applied_versions(conn)
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m.version) if m.version not in applied]
+
+
+def pending(bind=None):
+    bind = bind or get_engine()
+    with migration_lock(bind):
+        return _pending(bind)
+
+
+def upgrade(bind=None):
+    """Apply pending migrations, returns how many this process applied."""
+    bind = bind or get_engine()
+    count = 0
+    with migration_lock(bind):
+        # Read under the lock, what an earlier runner applied is not done twice
+        for m in _pending(bind):
+            try:
+                with bind.begin() as conn:
+                    m.apply(conn)
+                    conn.execute(insert(schema_migrations).values(version=m.version, description=m.description))
+            except DBAPIError as e:
+                if not already_applied(e):
+                    raise
+                continue
+            print(f"Applied migration {m.version}: {m.description}")
+            count += 1
+    return count
+
+
+def auto_migrate():
+    if SCHEMA_MIGRATIONS == "auto":
+        upgrade()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    parser.add_argument("--status", action="store_true", help="List pending migrations and exit")
+    args = parser.parse_args()
+    if args.status:
+        todo = pending()
+        for m in todo:
+            print(f"pending {m.version}: {m.description}")
+        print("up to date" if not todo else f"{len(todo)} pending")
+        sys.exit(0)
+    applied = upgrade()
+    print(f"{applied} migrations applied" if applied else "up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,13 @@
-from sqlalchemy import Column, Integer, String, LargeBinary, Boolean, ForeignKey
+from datetime import datetime, timezone
+
+from sqlalchemy import Column, Integer, String, LargeBinary, Boolean, ForeignKey, DateTime, Index, func, literal_column, text
+from sqlalchemy.orm import deferred
 from database import Base
 
+def utcnow():
+    # Aware, the DateTime columns are declared with timezone=True to match
+    return datetime.now(timezone.utc)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -10,6 +17,17 @@ class User(Base):
     password_hash = Column(String)
     role = Column(String)
 
+class Blob(Base):
+    __tablename__ = "blobs"
+
+    # SHA-256 of the content, the bytes themselves live in storage.blob_store
+    hash = Column(String(64), primary_key=True)
+    size = Column(Integer)
+    refcount = Column(Integer, default=0, nullable=False)
+    # How the bytes are stored: None (raw), "gzip" or "zstd"
+    encoding = Column(String(16), nullable=True)
+    stored_size = Column(Integer, nullable=True)
+
 class DBFile(Base):
     __tablename__ = "files"
 
@@ -17,9 +35,83 @@ class DBFile(Base):
     filename = Column(String, index=True)
     content_type = Column(String)
     size = Column(Integer)
-    data = Column(LargeBinary)
+    # Legacy inline storage, new uploads reference a Blob via content_hash
+    data = deferred(Column(LargeBinary, nullable=True))
+    content_hash = Column(String(64), ForeignKey('blobs.hash'), nullable=True, index=True)
+    # Copy of the blob's encoding so downloads need no join
+    content_encoding = Column(String(16), nullable=True)
     
     # New columns for folder structure
     is_folder = Column(Boolean, default=False)
     parent_id = Column(Integer, ForeignKey('files.id'), nullable=True)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=True)
+
+    # Keyset pagination indexes, one per listing sort, each leading with
+    # parent_id. Postgres also covers the listed columns for index-only scans
+    __table_args__ = (
+        # Names are unique within a folder (NULLs are distinct, hence the root index)
+        Index("uq_files_parent_filename", "parent_id", "filename", unique=True,
+              postgresql_include=["id", "size", "content_type", "is_folder"]),
+        Index("uq_files_root_filename", "filename", unique=True,
+              sqlite_where=text("parent_id IS NULL"),
+              postgresql_where=text("parent_id IS NULL")),
+        Index("ix_files_parent_size", "parent_id", "size", "id",
+              postgresql_include=["filename", "content_type", "is_folder"]),
+    )
+
+# content_type is NULL for uploads sent without one, NULLs would never match
+# the keyset predicate. The literal, not a bound '', lets the planner match
+# the expression index
+content_type_key = func.coalesce(DBFile.content_type, literal_column("''"))
+Index("ix_files_parent_type", DBFile.parent_id, content_type_key, DBFile.id,
+      postgresql_include=["filename", "size", "content_type", "is_folder"])
+
+class FolderVersion(Base):
+    __tablename__ = "folder_versions"
+
+    # Bumped whenever a direct child of the folder changes, 0 is the root
+    folder_id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=True)
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String, primary_key=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(32), nullable=False)
+    # Not a foreign key, jobs of deleted files just find nothing to do
+    file_id = Column(Integer, nullable=True, index=True)
+    # pending -> running -> done | failed, failed attempts go back to pending
+    status = Column(String(16), default="pending", nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=3, nullable=False)
+    result = Column(String, nullable=True)
+    last_error = Column(String, nullable=True)
+    run_after = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
 
+    # Random hex id, see resumable.py. The data lives in storage/uploads
+    id = Column(String(32), primary_key=True)
+    filename = Column(String, nullable=False)
+    content_type = Column(String, nullable=True)
+    parent_id = Column(Integer, nullable=True)
+    # Declared total size, and how much of it is safely on disk
+    length = Column(Integer, nullable=False)
+    received = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    # Pushed back by every write, abandoned sessions expire
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
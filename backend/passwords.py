@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+# Cost is tunable, hashes made with other rounds are upgraded on the next login
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", 29000))
+# "thread" is enough for pbkdf2 (hashlib releases the GIL), "process" isolates it fully
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# Requests allowed to wait for a worker before new ones are turned away
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 64))
+
+
+@lru_cache(maxsize=None)
+def get_context():
+    # Built when the first password is hashed, passlib is slow to set up
+    from passlib.context import CryptContext
+
+    # Use pbkdf2_sha256 which is pure python and robust on Windows
+    return CryptContext(
+        schemes=["pbkdf2_sha256"],
+        deprecated="auto",
+        pbkdf2_sha256__rounds=PASSWORD_HASH_ROUNDS,
+    )
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+class WaitStats:
+    """Time jobs spent queued before a worker picked them up."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "avg_seconds": self.total / self.count if self.count else 0.0,
+            "max_seconds": self.max,
+        }
+
+
+queue_wait = WaitStats()
+_pending = 0
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        pool = ProcessPoolExecutor if PASSWORD_HASH_EXECUTOR == "process" else ThreadPoolExecutor
+        _executor = pool(max_workers=PASSWORD_HASH_WORKERS)
+    return _executor
+
+
+def _timed(func, submitted_at, *args):
+    # Runs in the worker, reports how long the job sat in the queue
+    return time.perf_counter() - submitted_at, func(*args)
+
+
+def _hash(password):
+    return get_context().hash(password)
+
+
+def _verify_and_update(password, hashed):
+    return get_context().verify_and_update(password, hashed)
+
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_QUEUE:
+        raise HashQueueFull("Too many password checks in progress, try again shortly")
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        # perf_counter is system-wide, so it is comparable across worker processes
+        waited, result = await loop.run_in_executor(
+            _get_executor(), _timed, func, time.perf_counter(), *args
+        )
+        queue_wait.observe(waited)
+        return result
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password):
+    return await _run(_hash, password)
+
+
+async def verify_password(password, hashed):
+    """Returns (valid, new_hash). new_hash is set when the stored hash should be replaced."""
+    return await _run(_verify_and_update, password, hashed)
+
+
+def pending():
+    return _pending
@@ -0,0 +1,159 @@
+import asyncio
+import importlib.util
+import io
+import os
+import uuid
+from functools import lru_cache
+
+from starlette.concurrency import run_in_threadpool
+
+import storage
+from cache import ByteLRUCache
+
+# Pillow (required for previews), PyMuPDF (renders first pages of PDFs) and
+# pypdf (fallback, the first image embedded in a PDF) are all optional and
+# imported on the first render only
+
+# Requested widths are rounded up to one of these, so few renditions exist per blob
+PREVIEW_WIDTHS = tuple(int(w) for w in os.getenv("PREVIEW_WIDTHS", "64,128,256,512,1024").split(","))
+PREVIEW_DEFAULT_WIDTH = int(os.getenv("PREVIEW_DEFAULT_WIDTH", 256))
+# Memory budget of the in-process cache, rendered previews also stay on disk
+PREVIEW_CACHE_BYTES = int(os.getenv("PREVIEW_CACHE_BYTES", 64 * 1024 * 1024))
+# Refuse to decode images bigger than this (decompression bombs)
+PREVIEW_MAX_PIXELS = int(os.getenv("PREVIEW_MAX_PIXELS", 64_000_000))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", 80))
+
+MEDIA_TYPE = "image/webp"
+
+cache = ByteLRUCache(PREVIEW_CACHE_BYTES)
+_rendering = {}
+
+
+@lru_cache(maxsize=None)
+def _installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def is_previewable(content_type):
+    content_type = content_type or ""
+    if not _installed("PIL"):
+        return False
+    if content_type == "application/pdf":
+        return _installed("fitz") or _installed("pypdf")
+    # SVG is text, the browser can show it as it is
+    return content_type.startswith("image/") and content_type != "image/svg+xml"
+
+
+def snap_width(width):
+    for candidate in sorted(PREVIEW_WIDTHS):
+        if candidate >= width:
+            return candidate
+    return max(PREVIEW_WIDTHS)
+
+
+def preview_path(content_hash, width):
+    return os.path.join(storage.derived_dir(content_hash), f"preview-{width}.webp")
+
+
+def _open_source(content_hash, encoding):
+    if encoding is None:
+        path = storage.blob_store.path(content_hash)
+        if path is not None:
+            return path
+    return io.BytesIO(b"".join(storage.blob_store.iter(content_hash, encoding)))
+
+
+def _pdf_first_page(source, width):
+    from PIL import Image
+
+    if _installed("fitz"):
+        import fitz
+
+        document = fitz.open(source) if isinstance(source, str) else fitz.open(stream=source.getvalue())
+        with document:
+            page = document[0]
+            # Render just big enough for the requested width
+            zoom = width / page.rect.width
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+    import pypdf
+
+    reader = pypdf.PdfReader(source)
+    if not reader.pages:
+        return None
+    images = reader.pages[0].images
+    return images[0].image if images else None
+
+
+def render_preview(content_hash, encoding, content_type, width):
+    """WebP bytes of a preview at most width pixels wide, None if there is none. Blocking."""
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = PREVIEW_MAX_PIXELS
+    source = _open_source(content_hash, encoding)
+    try:
+        if content_type == "application/pdf":
+            image = _pdf_first_page(source, width)
+            if image is None:
+                return None
+        else:
+            image = Image.open(source)
+            # JPEG can decode straight at a fraction of the size, far cheaper
+            image.draft("RGB", (width, width * 4))
+            image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width * 4))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        out = io.BytesIO()
+        image.save(out, "WEBP", quality=PREVIEW_QUALITY)
+        return out.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Could not render a preview of {content_hash}: {e}")
+        return None
+
+
+def load_or_render(content_hash, encoding, content_type, width):
+    """Preview from disk, rendered and written there first if needed. Blocking."""
+    path = preview_path(content_hash, width)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    data = render_preview(content_hash, encoding, content_type, width)
+    if data:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return data
+
+
+async def get_preview(content_hash, encoding, content_type, width):
+    """Preview bytes, b"" if the content has none.
+
+    Keyed by content hash, so a preview is rendered once per content and
+    width, however many files share it and however often it is asked for.
+    """
+    key = (content_hash, width)
+    data = cache.get(key)
+    if data is not None:
+        return data
+    # Concurrent requests for the same preview wait for a single render
+    pending = _rendering.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    pending = _rendering[key] = asyncio.get_running_loop().create_future()
+    try:
+        data = await run_in_threadpool(load_or_render, content_hash, encoding, content_type, width) or b""
+        cache.set(key, data)
+        pending.set_result(data)
+        return data
+    except BaseException as e:
+        pending.set_exception(e)
+        pending.exception()  # Nobody else may be waiting, do not warn about it
+        raise
+    finally:
+        del _rendering[key]
@@ -0,0 +1,75 @@
+from sqlalchemy import select
+
+import jobs
+import models
+import previews
+import search
+import storage
+
+# Run for every stored file, in this order
+POST_UPLOAD_JOBS = ("index", "scan", "preview")
+
+# Stand-in for a real scanner: the EICAR test signature every antivirus detects
+EICAR_SIGNATURE = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+
+
+async def _load_file(db, file_id):
+    return (await db.execute(
+        select(models.DBFile.id, models.DBFile.filename, models.DBFile.content_type,
+               models.DBFile.content_hash, models.DBFile.content_encoding)
+        .where(models.DBFile.id == file_id)
+    )).first()
+
+
+def scan_blob(content_hash, encoding):
+    """True when the blob contains a known signature. Blocking."""
+    tail = b""
+    for chunk in storage.blob_store.iter(content_hash, encoding):
+        # Keep the end of the previous chunk, a signature may straddle two
+        if EICAR_SIGNATURE in tail + chunk:
+            return True
+        tail = (tail + chunk)[-len(EICAR_SIGNATURE):]
+    return False
+
+
+@jobs.handler("index")
+async def index_job(db, job):
+    row = await _load_file(db, job.file_id)
+    if row is None:
+        return "file deleted"
+    body = ""
+    if row.content_hash:
+        body = await jobs.run_blocking(
+            search.extract_text, row.content_hash, row.content_encoding, row.content_type, row.filename
+        )
+    await search.index_file(db, row.id, row.filename, body)
+    await db.commit()
+    return f"indexed {len(body)} characters"
+
+
+@jobs.handler("scan")
+async def scan_job(db, job):
+    row = await _load_file(db, job.file_id)
+    if row is None:
+        return "file deleted"
+    if not row.content_hash:
+        return "skipped"
+    if await jobs.run_blocking(scan_blob, row.content_hash, row.content_encoding):
+        print(f"File {row.id} ({row.filename}) matches a malware signature")
+        return "infected"
+    return "clean"
+
+
+@jobs.handler("preview")
+async def preview_job(db, job):
+    row = await _load_file(db, job.file_id)
+    if row is None:
+        return "file deleted"
+    if not row.content_hash or not previews.is_previewable(row.content_type):
+        return "skipped"
+    # Written to disk, the first request then only has to read it
+    data = await jobs.run_blocking(
+        previews.load_or_render, row.content_hash, row.content_encoding, row.content_type,
+        previews.PREVIEW_DEFAULT_WIDTH
+    )
+    return f"{len(data)} bytes" if data else "no preview"
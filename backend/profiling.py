@@ -0,0 +1,121 @@
+import os
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Development aid, off unless SQL_PROFILE=1. Costs a dict update per
+# statement, plus an EXPLAIN round trip for every slow one
+SQL_PROFILE = os.getenv("SQL_PROFILE", "0") == "1"
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", 100))
+SQL_EXPLAIN = os.getenv("SQL_EXPLAIN", "1") == "1"
+# A request running one statement shape more often than this smells of N+1
+SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", 5))
+
+_WHITESPACE = re.compile(r"\s+")
+_PLACEHOLDER_LIST = re.compile(r"\((?:\s*(?:\?|%s|\$\d+|:\w+)\s*,)+\s*(?:\?|%s|\$\d+|:\w+)\s*\)")
+_NUMBER = re.compile(r"\b\d+\b")
+_EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")
+
+
+class RequestProfile:
+    __slots__ = ("shapes", "queries", "query_time", "slow")
+
+    def __init__(self):
+        self.shapes = Counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.slow = 0
+
+    def repeated(self):
+        return [(shape, count) for shape, count in self.shapes.most_common()
+                if count > SQL_N_PLUS_ONE_THRESHOLD]
+
+    def report(self):
+        return f"queries={self.queries}; time_ms={self.query_time * 1000:.1f}; slow={self.slow}; repeated={len(self.repeated())}"
+
+
+current_profile = ContextVar("current_profile", default=None)
+
+
+def statement_shape(statement):
+    """Statement text with IN lists and literal numbers folded, for grouping."""
+    shape = _WHITESPACE.sub(" ", statement).strip()
+    shape = _PLACEHOLDER_LIST.sub("(?...)", shape)
+    return _NUMBER.sub("?", shape)
+
+
+def explain(conn, statement, parameters):
+    # A separate cursor, the one of the statement still holds its results
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join("    " + " | ".join(str(value) for value in row) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def instrument_engine(target):
+    @event.listens_for(target, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._profile_started = time.perf_counter()
+
+    @event.listens_for(target, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._profile_started
+        profile = current_profile.get()
+        if profile is not None:
+            profile.shapes[statement_shape(statement)] += 1
+            profile.queries += 1
+            profile.query_time += elapsed
+        if elapsed * 1000 < SQL_SLOW_QUERY_MS:
+            return
+        if profile is not None:
+            profile.slow += 1
+        print(f"[sql] slow statement, {elapsed * 1000:.1f} ms: {_WHITESPACE.sub(' ', statement)[:500]}")
+        if SQL_EXPLAIN and not executemany and statement.lstrip().upper().startswith(_EXPLAINABLE):
+            try:
+                print(f"[sql] plan:\n{explain(conn, statement, parameters)}")
+            except Exception as e:
+                print(f"[sql] EXPLAIN failed: {e}")
+
+
+class QueryProfileMiddleware:
+    """Adds an X-Query-Report header and logs one line per request.
+
+    Statements run while the body is streamed are in the log line only,
+    the header is sent before them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile()
+        token = current_profile.set(profile)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", ()))
+                headers.append((b"x-query-report", profile.report().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            elapsed = time.perf_counter() - started
+            print(
+                f"[sql] {scope['method']} {scope['path']} {elapsed * 1000:.1f} ms, "
+                f"{profile.queries} queries in {profile.query_time * 1000:.1f} ms"
+            )
+            for shape, count in profile.repeated():
+                print(f"[sql] possible N+1, {count}x: {shape[:300]}")
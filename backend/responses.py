@@ -0,0 +1,30 @@
+import dataclasses
+import json
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Optional, the standard library encoder is used instead
+    orjson = None
+
+
+def _default(obj):
+    if dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    """JSON bytes of content, dataclasses included."""
+    if orjson is not None:
+        # Serializes dataclasses (slots too) natively, in one pass of C code
+        return orjson.dumps(content)
+    return json.dumps(
+        content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
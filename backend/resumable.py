@@ -0,0 +1,214 @@
+import hashlib
+import os
+import time
+import uuid
+from datetime import timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows, local development only
+    fcntl = None
+
+from sqlalchemy import delete, select
+from starlette.concurrency import run_in_threadpool
+
+import models
+import storage
+
+# Resumable uploads, a small subset of the tus protocol: create a session,
+# PATCH the body in pieces from the current offset, ask for that offset
+# after a failure (HEAD) and finalize. A retry only resends what is missing
+UPLOADS_DIR = os.path.join(storage.STORAGE_DIR, "uploads")
+# Sessions without a write for this long are abandoned and garbage-collected
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+# Expired sessions are looked for at most this often, when a new one is created
+UPLOAD_GC_INTERVAL = float(os.getenv("UPLOAD_GC_INTERVAL", 600))
+
+CHUNK_MEDIA_TYPE = "application/offset+octet-stream"
+
+# Sessions a request of this process is writing to right now. Other
+# processes are kept out by a lock on the part file
+_writing = set()
+_last_collect = 0.0
+
+
+class UploadBusy(Exception):
+    pass
+
+
+def new_session_id():
+    # Random, knowing the id is what allows writing to the upload
+    return uuid.uuid4().hex
+
+
+def part_path(upload_id):
+    return os.path.join(UPLOADS_DIR, f"{upload_id}.part")
+
+
+def expires_at():
+    return models.utcnow() + timedelta(seconds=UPLOAD_SESSION_TTL)
+
+
+def create_part(upload_id):
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    open(part_path(upload_id), "wb").close()
+
+
+def _lock_part(f):
+    # Exclusive across workers, released when f is closed
+    if fcntl is None:
+        return
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        raise UploadBusy("Another request is writing to this upload")
+
+
+def finish_part(upload_id, length):
+    """Check and hash a complete upload. Blocking, run it off the event loop.
+
+    Returns (size on disk, SHA-256 hex digest). The digest is None when the
+    part file holds fewer than length bytes, the client has to resume from
+    the size on disk.
+    """
+    with open(part_path(upload_id), "r+b") as f:
+        _lock_part(f)
+        size = os.fstat(f.fileno()).st_size
+        if size < length:
+            return size, None
+        if size > length:
+            # Nothing past the declared length belongs to the upload
+            f.truncate(length)
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(storage.UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        return length, digest.hexdigest()
+
+
+def _open_part(upload_id, offset):
+    f = open(part_path(upload_id), "r+b")
+    _lock_part(f)
+    # Bytes past the recorded offset were written by a request that never
+    # got to record them, the client sends them again
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def _close_part(f):
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+class PartWriter:
+    """Appends a PATCH body to the part file of an upload, from offset.
+
+    Data is written in UPLOAD_CHUNK_SIZE pieces and synced to disk on exit,
+    before the new offset gets recorded. received is the offset reached, also
+    when the body was cut short, so whatever arrived counts.
+    """
+
+    def __init__(self, upload_id, offset, length):
+        self.upload_id = upload_id
+        self.received = offset
+        self.length = length
+        self._buffer = bytearray()
+        self._file = None
+
+    async def __aenter__(self):
+        if self.upload_id in _writing:
+            raise UploadBusy("Another request is writing to this upload")
+        _writing.add(self.upload_id)
+        try:
+            self._file = await run_in_threadpool(_open_part, self.upload_id, self.received)
+        except BaseException:
+            _writing.discard(self.upload_id)
+            raise
+        return self
+
+    async def write(self, chunk):
+        if self.received + len(self._buffer) + len(chunk) > self.length:
+            raise storage.UploadTooLarge(f"Upload is declared as {self.length} bytes")
+        self._buffer += chunk
+        if len(self._buffer) >= storage.UPLOAD_CHUNK_SIZE:
+            await self._flush()
+
+    async def _flush(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            await run_in_threadpool(self._file.write, data)
+            self.received += len(data)
+            self._buffer.clear()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self._flush()
+            await run_in_threadpool(_close_part, self._file)
+        finally:
+            _writing.discard(self.upload_id)
+
+
+async def get_session(db, upload_id):
+    return await db.scalar(select(models.UploadSession).where(
+        models.UploadSession.id == upload_id,
+        models.UploadSession.expires_at >= models.utcnow()
+    ))
+
+
+def discard_part(upload_id):
+    storage.discard_spool(part_path(upload_id))
+
+
+def _orphaned_parts(known_ids, older_than):
+    # Part files whose session row never got committed or was removed
+    orphans = []
+    if not os.path.isdir(UPLOADS_DIR):
+        return orphans
+    for name in os.listdir(UPLOADS_DIR):
+        upload_id = name.split(".", 1)[0]
+        path = os.path.join(UPLOADS_DIR, name)
+        if upload_id in known_ids:
+            continue
+        try:
+            if os.path.getmtime(path) < older_than:
+                orphans.append(path)
+        except FileNotFoundError:
+            pass
+    return orphans
+
+
+async def collect_expired(db, force=False):
+    """Remove abandoned upload sessions and their data, returns how many.
+
+    Runs at most every UPLOAD_GC_INTERVAL seconds per process unless forced.
+    """
+    global _last_collect
+    now = time.monotonic()
+    if not force and now - _last_collect < UPLOAD_GC_INTERVAL:
+        return 0
+    _last_collect = now
+
+    expired = (await db.scalars(
+        delete(models.UploadSession)
+        .where(models.UploadSession.expires_at < models.utcnow())
+        .returning(models.UploadSession.id)
+    )).all()
+    known_ids = set((await db.scalars(select(models.UploadSession.id))).all())
+    await db.commit()
+
+    def remove():
+        for upload_id in expired:
+            discard_part(upload_id)
+        orphans = _orphaned_parts(known_ids | _writing, time.time() - UPLOAD_SESSION_TTL)
+        for path in orphans:
+            storage.discard_spool(path)
+        return len(orphans)
+
+    orphans = await run_in_threadpool(remove)
+    if expired or orphans:
+        print(f"Removed {len(expired)} expired upload sessions and {orphans} orphaned part files")
+    return len(expired)
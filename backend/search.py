@@ -0,0 +1,161 @@
+import html
+import io
+import os
+import re
+from collections import namedtuple
+
+from sqlalchemy import column, delete, table, text
+
+import storage
+
+# Extracted text is capped, the first pages carry most of the useful terms
+SEARCH_MAX_CHARS = int(os.getenv("SEARCH_MAX_CHARS", 200_000))
+SEARCH_MAX_PDF_PAGES = int(os.getenv("SEARCH_MAX_PDF_PAGES", 50))
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# Snippets come back with these around the matches. The text between them is
+# user content, it gets HTML-escaped before the markers turn into <b> tags
+HIT_START, HIT_END = "\x02", "\x03"
+
+Hit = namedtuple("Hit", "id rank snippet")
+
+
+# Schema. SQLite uses an FTS5 table keyed by file id (rowid), Postgres a
+# tsvector column with a GIN index
+
+def ensure_search_schema(conn):
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5("
+            "filename, body, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+    else:
+        conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS file_search ("
+            "file_id INTEGER PRIMARY KEY, body TEXT, document TSVECTOR)"
+        )
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_file_search_document ON file_search USING GIN (document)"
+        )
+
+
+# Lightweight handles for statements built with the expression language
+files_fts = table("files_fts", column("rowid"))
+file_search = table("file_search", column("file_id"))
+
+
+def _is_sqlite(db):
+    return db.bind.dialect.name == "sqlite"
+
+
+# Text extraction
+
+def extract_text(content_hash, encoding, content_type, filename):
+    """Searchable text of a stored blob, empty for types we cannot read.
+
+    Blocking, run it off the event loop.
+    """
+    content_type = content_type or ""
+    if storage.is_compressible(content_type):
+        chunks, size = [], 0
+        for chunk in storage.blob_store.iter(content_hash, encoding):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= SEARCH_MAX_CHARS:
+                break
+        return b"".join(chunks)[:SEARCH_MAX_CHARS].decode("utf-8", errors="ignore")
+
+    if content_type == "application/pdf" or filename.lower().endswith(".pdf"):
+        try:
+            # Imported on first use, it is the slowest import of the app
+            import pypdf
+        except ImportError:  # PDFs are then indexed by file name only
+            return ""
+        try:
+            path = storage.blob_store.path(content_hash, encoding) if encoding is None else None
+            source = path or io.BytesIO(b"".join(storage.blob_store.iter(content_hash, encoding)))
+            reader = pypdf.PdfReader(source)
+            parts, size = [], 0
+            for page in reader.pages[:SEARCH_MAX_PDF_PAGES]:
+                page_text = page.extract_text() or ""
+                parts.append(page_text)
+                size += len(page_text)
+                if size >= SEARCH_MAX_CHARS:
+                    break
+            return "\n".join(parts)[:SEARCH_MAX_CHARS]
+        except Exception as e:
+            print(f"Could not extract text from {filename}: {e}")
+    return ""
+
+
+# Index maintenance, incremental per file
+
+async def index_file(db, file_id, filename, body=""):
+    # Plain text has no NUL bytes, Postgres rejects them in TEXT anyway.
+    # Nor the highlight markers, which must only come from the snippet
+    body = body.replace("\x00", " ").replace(HIT_START, " ").replace(HIT_END, " ")
+    if _is_sqlite(db):
+        await db.execute(text("DELETE FROM files_fts WHERE rowid = :id"), {"id": file_id})
+        await db.execute(
+            text("INSERT INTO files_fts (rowid, filename, body) VALUES (:id, :filename, :body)"),
+            {"id": file_id, "filename": filename, "body": body}
+        )
+    else:
+        await db.execute(text(
+            "INSERT INTO file_search (file_id, body, document) VALUES (:id, :body, "
+            "setweight(to_tsvector('simple', :filename), 'A') || setweight(to_tsvector('english', :body), 'B')) "
+            "ON CONFLICT (file_id) DO UPDATE SET body = EXCLUDED.body, document = EXCLUDED.document"
+        ), {"id": file_id, "filename": filename, "body": body})
+
+
+async def unindex(db, file_ids):
+    """Remove index rows, file_ids is a list of ids or a SELECT of ids (e.g. a subtree)."""
+    if isinstance(file_ids, (list, tuple, set)) and not file_ids:
+        return
+    if _is_sqlite(db):
+        await db.execute(delete(files_fts).where(files_fts.c.rowid.in_(file_ids)))
+    else:
+        await db.execute(delete(file_search).where(file_search.c.file_id.in_(file_ids)))
+
+
+# Queries
+
+def to_query(user_query):
+    """Words of the user query as safe prefix terms, all of which must match."""
+    return [token.lower() for token in _TOKEN.findall(user_query)][:16]
+
+
+def highlight(snippet):
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(HIT_START, "<b>").replace(HIT_END, "</b>")
+
+
+async def search(db, user_query, limit=20):
+    """(file id, rank, snippet) tuples, best match first.
+
+    Snippets are HTML, matches in <b> and everything else escaped.
+    """
+    terms = to_query(user_query)
+    if not terms:
+        return []
+    if _is_sqlite(db):
+        # Quoted terms cannot inject FTS5 syntax, * makes them prefix matches.
+        # bm25 is lower-is-better, names weigh ten times the body
+        match = " ".join(f'"{term}"*' for term in terms)
+        rows = await db.execute(text(
+            "SELECT rowid AS id, bm25(files_fts, 10.0, 1.0) AS rank, "
+            "snippet(files_fts, 1, :start, :stop, '...', 12) AS snippet "
+            "FROM files_fts WHERE files_fts MATCH :match ORDER BY rank LIMIT :limit"
+        ), {"match": match, "limit": limit, "start": HIT_START, "stop": HIT_END})
+    else:
+        match = " & ".join(f"{term}:*" for term in terms)
+        rows = await db.execute(text(
+            "SELECT file_id AS id, -ts_rank(document, query) AS rank, "
+            "ts_headline('english', coalesce(body, ''), query, :options) AS snippet "
+            "FROM file_search, to_tsquery('english', :match) AS query "
+            "WHERE document @@ query ORDER BY rank LIMIT :limit"
+        ), {"match": match, "limit": limit,
+            "options": f'StartSel="{HIT_START}", StopSel="{HIT_END}", MaxWords=24'})
+    return [Hit(row.id, row.rank, highlight(row.snippet)) for row in rows]
@@ -0,0 +1,464 @@
+import abc
+import gzip
+import hashlib
+import os
+import shutil
+import uuid
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for STORAGE_COMPRESSION=zstd
+    zstandard = None
+
+from sqlalchemy import bindparam, delete, select, update
+from starlette.concurrency import run_in_threadpool
+
+import database
+import models
+
+# Uploaded file bodies live on disk, the database only keeps metadata
+STORAGE_DIR = os.getenv("STORAGE_DIR", "./storage")
+BLOB_STORE = os.getenv("BLOB_STORE", "filesystem")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 500 * 1024 * 1024))
+# "gzip", "zstd" (needs the zstandard package) or "off"
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "gzip")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+# Keep the raw bytes unless compression saves at least 10%
+COMPRESSION_MAX_RATIO = float(os.getenv("COMPRESSION_MAX_RATIO", 0.9))
+
+BLOBS_DIR = os.path.join(STORAGE_DIR, "blobs")
+SPOOL_DIR = os.path.join(STORAGE_DIR, "spool")
+# Renditions derived from a blob (previews), removed together with it
+DERIVED_DIR = os.path.join(STORAGE_DIR, "derived")
+# Directories are created on the first write, importing must work on a
+# read-only code directory (serverless)
+
+# Serverless instances (Vercel) lose their disk when they go away, and
+# FileSystemBlobStore is the only store so far
+EPHEMERAL_DISK = bool(os.getenv("VERCEL"))
+if EPHEMERAL_DISK and BLOB_STORE == "filesystem":
+    print(
+        "WARNING: file bodies are stored on this instance's ephemeral disk "
+        f"({os.path.abspath(STORAGE_DIR)}) and will be lost with it. "
+        "Run the backend on a host with a durable STORAGE_DIR for uploads to persist."
+    )
+
+if STORAGE_COMPRESSION == "zstd" and zstandard is None:
+    raise RuntimeError("STORAGE_COMPRESSION=zstd needs the zstandard package")
+
+
+# Content types that shrink when deflated, everything else (images, video,
+# audio, PDFs, office files and archives) is already compressed
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/xml", "application/javascript",
+    "application/x-javascript", "application/sql", "application/x-sh",
+    "application/x-python", "image/svg+xml", "application/x-ipynb+json",
+)
+
+
+def is_compressible(content_type):
+    return (content_type or "").startswith(COMPRESSIBLE_TYPES)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def new_spool_path():
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    return os.path.join(SPOOL_DIR, f"{uuid.uuid4().hex}.part")
+
+
+def spool_stream(source, max_size=MAX_UPLOAD_SIZE):
+    """Copy a readable binary stream to a spool file chunk by chunk.
+
+    Returns (spool_path, size, sha256 hex digest). Only one chunk is held in
+    memory at a time, so peak memory does not depend on the file size.
+    Blocking, run it off the event loop.
+    """
+    spool_path = new_spool_path()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(spool_path, "wb") as out:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(f"File exceeds the {max_size} byte limit")
+                digest.update(chunk)
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+    except BaseException:
+        discard_spool(spool_path)
+        raise
+    return spool_path, size, digest.hexdigest()
+
+
+def discard_spool(spool_path):
+    try:
+        os.remove(spool_path)
+    except FileNotFoundError:
+        pass
+
+
+def iter_file(path, chunk_size=UPLOAD_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def slice_chunks(chunks, start, length):
+    """The bytes start to start + length of a chunk iterator, as chunks."""
+    for chunk in chunks:
+        if start >= len(chunk):
+            start -= len(chunk)
+            continue
+        piece = chunk[start:start + length]
+        start = 0
+        length -= len(piece)
+        yield piece
+        if length <= 0:
+            break
+
+
+# Compression at rest, only for compressible content types. Blobs are
+# stored in one encoding and served as-is to clients that accept it
+ENCODING_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def _open_decoder(f, encoding):
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    return f
+
+
+def compress_spool(spool_path, size, content_type, encoding=STORAGE_COMPRESSION):
+    """Compress a spooled upload if it is worth it.
+
+    Returns (spool_path, encoding, stored_size); the original spool is kept
+    (and encoding is None) for incompressible types or poor ratios.
+    Blocking, run it off the event loop.
+    """
+    if encoding not in ("gzip", "zstd") or size < COMPRESSION_MIN_SIZE or not is_compressible(content_type):
+        return spool_path, None, size
+    compressed_path = f"{spool_path}{ENCODING_SUFFIXES[encoding]}"
+    try:
+        with open(spool_path, "rb") as src, open(compressed_path, "wb") as raw:
+            if encoding == "gzip":
+                # mtime=0 keeps the output identical for identical content
+                out = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0)
+            else:
+                out = zstandard.ZstdCompressor(level=9).stream_writer(raw, closefd=False)
+            with out:
+                for chunk in iter(lambda: src.read(UPLOAD_CHUNK_SIZE), b""):
+                    out.write(chunk)
+            raw.flush()
+            os.fsync(raw.fileno())
+        stored_size = os.path.getsize(compressed_path)
+    except BaseException:
+        discard_spool(compressed_path)
+        raise
+    if stored_size > size * COMPRESSION_MAX_RATIO:
+        discard_spool(compressed_path)
+        return spool_path, None, size
+    discard_spool(spool_path)
+    return compressed_path, encoding, stored_size
+
+
+class BlobStore(abc.ABC):
+    """Content-addressed storage for file bodies, keyed by SHA-256 hex digest.
+
+    The hash is always of the original bytes, encoding says how they are stored.
+    """
+
+    @abc.abstractmethod
+    def put(self, spool_path, content_hash, encoding=None):
+        ...
+
+    @abc.abstractmethod
+    def exists(self, content_hash, encoding=None):
+        ...
+
+    def path(self, content_hash, encoding=None):
+        # Local file path for FileResponse, None if the store has none
+        return None
+
+    @abc.abstractmethod
+    def iter(self, content_hash, encoding=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        """Decoded content, chunk by chunk."""
+
+    @abc.abstractmethod
+    def iter_raw(self, content_hash, encoding=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        """Stored bytes as they are, still encoded."""
+
+    @abc.abstractmethod
+    def delete(self, content_hash):
+        ...
+
+    @abc.abstractmethod
+    def bury(self, content_hash):
+        """Move the stored copies out of the way, returns [(tombstone, path)].
+
+        Removing the tombstones deletes the blob, renaming them back restores it.
+        """
+
+
+class FileSystemBlobStore(BlobStore):
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, content_hash, encoding=None):
+        # Two levels of 256-way sharding keep directories small
+        return os.path.join(
+            self.root, content_hash[:2], content_hash[2:4], content_hash + ENCODING_SUFFIXES[encoding]
+        )
+
+    def put(self, spool_path, content_hash, encoding=None):
+        target = self.path(content_hash, encoding)
+        if os.path.exists(target):
+            # Identical content is already stored once
+            discard_spool(spool_path)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Atomic on the same filesystem, readers never see a partial blob
+        os.replace(spool_path, target)
+
+    def exists(self, content_hash, encoding=None):
+        return os.path.exists(self.path(content_hash, encoding))
+
+    def iter(self, content_hash, encoding=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        with open(self.path(content_hash, encoding), "rb") as f:
+            source = _open_decoder(f, encoding)
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_raw(self, content_hash, encoding=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        return iter_file(self.path(content_hash, encoding), chunk_size)
+
+    def delete(self, content_hash):
+        for encoding in ENCODING_SUFFIXES:
+            try:
+                os.remove(self.path(content_hash, encoding))
+            except FileNotFoundError:
+                pass
+
+    def bury(self, content_hash):
+        buried = []
+        for encoding in ENCODING_SUFFIXES:
+            buried += bury_path(self.path(content_hash, encoding))
+        return buried
+
+
+def derived_dir(content_hash):
+    return os.path.join(DERIVED_DIR, content_hash[:2], content_hash)
+
+
+def bury_path(path):
+    # Same directory, so the rename is atomic. [] if there is nothing at path
+    tombstone = f"{path}.{uuid.uuid4().hex}.dead"
+    try:
+        os.rename(path, tombstone)
+    except FileNotFoundError:
+        return []
+    return [(tombstone, path)]
+
+
+def remove_tombstones(buried):
+    for tombstone, _ in buried:
+        if os.path.isdir(tombstone):
+            shutil.rmtree(tombstone, ignore_errors=True)
+        else:
+            discard_spool(tombstone)
+
+
+def restore_tombstones(buried):
+    for tombstone, path in buried:
+        try:
+            os.rename(tombstone, path)
+        except OSError as e:
+            print(f"Could not restore {path}: {e}")
+
+
+def get_blob_store(kind=BLOB_STORE):
+    if kind == "filesystem":
+        return FileSystemBlobStore(BLOBS_DIR)
+    raise ValueError(f"Unknown BLOB_STORE: {kind}")
+
+
+blob_store = get_blob_store()
+
+
+# Reference counting, so a blob is removed only when no file points at it
+
+async def blob_encodings(db, content_hashes):
+    """{hash: encoding} for the hashes that are already stored."""
+    if not content_hashes:
+        return {}
+    rows = await db.execute(
+        select(models.Blob.hash, models.Blob.encoding).where(models.Blob.hash.in_(list(content_hashes)))
+    )
+    return dict(rows.all())
+
+
+async def store_blob(db, spool_path, content_hash, size, content_type):
+    """Reference (or first store) the content of a spooled upload, returns its encoding."""
+    known = await blob_encodings(db, [content_hash])
+    if content_hash in known:
+        # Only written if the stored copy went away meanwhile
+        spool_encoding, stored_size = None, size
+    else:
+        spool_path, spool_encoding, stored_size = await run_in_threadpool(
+            compress_spool, spool_path, size, content_type
+        )
+    try:
+        encoding = await acquire_blob(db, content_hash, size, spool_encoding, stored_size)
+        return await run_in_threadpool(place_blob, spool_path, content_hash, spool_encoding, encoding)
+    except BaseException:
+        discard_spool(spool_path)
+        raise
+
+
+def place_blob(spool_path, content_hash, spool_encoding, encoding):
+    """Keep a spool as the stored copy of a blob stored in encoding, unless it has one.
+
+    Returns the encoding the file row should use. A spool in another encoding
+    than the blob row (a concurrent first upload compressed differently) is
+    stored as is when the row's copy is missing. Blocking.
+    """
+    if spool_encoding != encoding and blob_store.exists(content_hash, encoding):
+        discard_spool(spool_path)
+        return encoding
+    blob_store.put(spool_path, content_hash, spool_encoding)
+    return spool_encoding
+
+
+async def acquire_blob(db, content_hash, size, encoding=None, stored_size=None):
+    """Add a reference, creating the blob row if there is none. Returns the row's encoding.
+
+    encoding and stored_size describe the copy at hand, they are only used for a new row.
+    """
+    encodings = await acquire_blob_counts(db, {content_hash: 1}, {content_hash: (size, encoding, stored_size)})
+    return encodings[content_hash]
+
+
+async def reference_blob(db, content_hash, size):
+    """Add a reference to content that is already stored, without receiving it again.
+
+    Returns the blob row (hash, encoding), None if no live blob has that hash
+    and size. Blobs down to zero references are about to be collected, not reused.
+    """
+    return (await db.execute(
+        update(models.Blob)
+        .where(models.Blob.hash == content_hash, models.Blob.size == size, models.Blob.refcount > 0)
+        .values(refcount=models.Blob.refcount + 1)
+        .returning(models.Blob.hash, models.Blob.encoding)
+    )).first()
+
+
+# Rows per upsert, well below SQLite's limit on bound parameters
+ACQUIRE_BATCH = 1000
+
+
+async def acquire_blob_counts(db, counts, spooled):
+    """Add count references per hash in a {hash: count} mapping, batched.
+
+    spooled maps every hash to (size, encoding, stored_size) of the copy at
+    hand, used for rows that do not exist yet. One upsert per batch, so two
+    uploads of new content never both insert. Returns {hash: row encoding}.
+    """
+    blobs = models.Blob.__table__
+    hashes = sorted(counts)  # Same lock order in every transaction
+    encodings = {}
+    for start in range(0, len(hashes), ACQUIRE_BATCH):
+        stmt = database.upsert(db.bind, blobs).values([
+            {
+                "hash": h, "size": spooled[h][0], "refcount": counts[h], "encoding": spooled[h][1],
+                "stored_size": spooled[h][0] if spooled[h][2] is None else spooled[h][2],
+            }
+            for h in hashes[start:start + ACQUIRE_BATCH]
+        ])
+        rows = await db.execute(stmt.on_conflict_do_update(
+            index_elements=[blobs.c.hash],
+            set_={"refcount": blobs.c.refcount + stmt.excluded.refcount}
+        ).returning(blobs.c.hash, blobs.c.encoding))
+        encodings.update(rows.all())
+    return encodings
+
+
+async def release_blobs(db, content_hashes):
+    """Drop one reference per entry. Returns the hashes to collect after commit."""
+    counts = {}
+    for content_hash in content_hashes:
+        if content_hash is not None:
+            counts[content_hash] = counts.get(content_hash, 0) + 1
+    return await release_blob_counts(db, counts)
+
+
+async def release_blob_counts(db, counts):
+    """Drop count references per hash in a {hash: count} mapping, one executemany."""
+    if not counts:
+        return []
+    blobs = models.Blob.__table__
+    hashes = sorted(counts)  # Same lock order as acquire_blob_counts
+    await db.execute(
+        update(blobs)
+        .where(blobs.c.hash == bindparam("b_hash"))
+        .values(refcount=blobs.c.refcount - bindparam("b_count")),
+        [{"b_hash": h, "b_count": counts[h]} for h in hashes]
+    )
+    return hashes
+
+
+async def collect_blobs(db, content_hashes):
+    """Delete unreferenced blobs, call after the releasing transaction commits.
+
+    The files are moved to tombstones before the deletion commits and removed
+    after it. An upload of the same content meanwhile waits for the blob row
+    and then stores a new copy, which this never touches.
+    """
+    if not content_hashes:
+        return
+    orphans = (await db.scalars(
+        select(models.Blob.hash).where(
+            models.Blob.hash.in_(content_hashes),
+            models.Blob.refcount <= 0
+        )
+    )).all()
+    if not orphans:
+        return
+    # Only rows actually deleted, a blob referenced again meanwhile stays
+    orphans = (await db.scalars(
+        delete(models.Blob).where(
+            models.Blob.hash.in_(orphans),
+            models.Blob.refcount <= 0
+        ).returning(models.Blob.hash)
+    )).all()
+
+    def bury():
+        buried = []
+        for content_hash in orphans:
+            buried += blob_store.bury(content_hash)
+            buried += bury_path(derived_dir(content_hash))
+        return buried
+
+    buried = await run_in_threadpool(bury)
+    try:
+        await db.commit()
+    except BaseException:
+        # The rows are still there, so are their files
+        await run_in_threadpool(restore_tombstones, buried)
+        raise
+    await run_in_threadpool(remove_tombstones, buried)
@@ -0,0 +1,62 @@
+"""Functional tests of the backend, in process against a scratch SQLite database:
+
+    cd backend && python -m pytest -q
+
+The database and storage directory are set before the app is imported, its
+modules read their settings at import. Tests share one database, each one
+works in folders or files of its own.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.mkdtemp()
+# Assigned, not defaulted: a DATABASE_URL from the shell must never be the test database
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+os.environ["STORAGE_DIR"] = os.path.join(_tmp, "storage")
+os.environ["JOB_RECOVERY_DELAY"] = "0"
+os.environ.setdefault("PASSWORD_HASH_ROUNDS", "1000")
+
+from fastapi.testclient import TestClient
+
+import main
+import models
+import storage
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def folder(client, request):
+    # An empty folder per test, named after it
+    response = client.post("/folders/create", json={"name": request.node.name})
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def upload(client, name, body, folder_id=None, content_type="application/octet-stream"):
+    data = {"parent_id": str(folder_id)} if folder_id is not None else {}
+    response = client.post("/files/upload", files={"file": (name, body, content_type)}, data=data)
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def blob_row(content_hash):
+    with main.SessionLocal() as session:
+        return session.get(models.Blob, content_hash)
+
+
+def stored_files(content_hash):
+    # Every file the blob store holds for content_hash, tombstones included
+    directory = os.path.dirname(storage.blob_store.path(content_hash))
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if name.startswith(content_hash))
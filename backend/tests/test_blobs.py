@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+
+from sqlalchemy import event
+
+import database
+import jobs
+import storage
+from conftest import blob_row, stored_files, upload
+
+
+def digest(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+def test_identical_uploads_share_one_blob(client, folder):
+    body = b"same bytes " * 1000
+    first = upload(client, "one.txt", body, folder, "text/plain")
+    second = upload(client, "two.txt", body, folder, "text/plain")
+
+    assert blob_row(digest(body)).refcount == 2
+    assert len(stored_files(digest(body))) == 1
+    for file_id in (first, second):
+        assert client.get(f"/files/download/{file_id}", headers={"Accept-Encoding": "identity"}).content == body
+
+
+def test_replacing_a_file_releases_its_old_content(client, folder):
+    old, new = b"first version", b"second version"
+    upload(client, "report.bin", old, folder)
+    file_id = upload(client, "report.bin", new, folder)
+
+    assert blob_row(digest(old)) is None
+    assert stored_files(digest(old)) == []
+    assert blob_row(digest(new)).refcount == 1
+    assert client.get(f"/files/download/{file_id}").content == new
+
+
+def test_blob_lives_until_its_last_file_is_deleted(client, folder):
+    body = b"kept while referenced"
+    first = upload(client, "a.bin", body, folder)
+    second = upload(client, "b.bin", body, folder)
+
+    assert client.delete(f"/files/delete/{first}").status_code == 200
+    assert blob_row(digest(body)).refcount == 1
+    assert client.get(f"/files/download/{second}").content == body
+
+    assert client.delete(f"/files/delete/{second}").status_code == 200
+    assert blob_row(digest(body)) is None
+    # Tombstones are gone too
+    assert stored_files(digest(body)) == []
+
+
+def test_deleting_a_folder_releases_its_contents(client, folder):
+    sub = client.post("/folders/create", json={"name": "inner", "parent_id": folder}).json()["id"]
+    shared, private = b"also outside", b"only inside"
+    outside = upload(client, "outside.bin", shared, folder)
+    upload(client, "copy.bin", shared, sub)
+    upload(client, "private.bin", private, sub)
+
+    assert client.delete(f"/files/delete/{sub}").status_code == 200
+    assert blob_row(digest(shared)).refcount == 1
+    assert blob_row(digest(private)) is None
+    assert stored_files(digest(private)) == []
+    assert client.get(f"/files/download/{outside}").content == shared
+
+
+def count_delete_statements(client, folder_id):
+    # Background jobs of the uploads would be counted too
+    client.portal.call(jobs.drain)
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.get_async_engine().sync_engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        assert client.delete(f"/files/delete/{folder_id}").status_code == 200
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return len(statements)
+
+
+def test_folder_delete_statements_do_not_grow_with_its_files(client, folder):
+    counts = []
+    for size in (2, 50):
+        sub = client.post("/folders/create", json={"name": f"inner-{size}", "parent_id": folder}).json()["id"]
+        for i in range(size):
+            upload(client, f"{i}.bin", f"file {i} of {size}".encode(), sub)
+        counts.append(count_delete_statements(client, sub))
+    assert counts[0] == counts[1]
+
+
+def test_content_comes_back_after_collection(client, folder):
+    body = b"deleted, then uploaded again"
+    assert client.delete(f"/files/delete/{upload(client, 'x.bin', body, folder)}").status_code == 200
+    file_id = upload(client, "x.bin", body, folder)
+
+    assert blob_row(digest(body)).refcount == 1
+    assert client.get(f"/files/download/{file_id}").content == body
+
+
+def test_failed_collection_keeps_the_files(client, folder):
+    body = b"the commit fails"
+    upload(client, "c.bin", body, folder)
+    files = stored_files(digest(body))
+
+    async def collect_with_failing_commit():
+        async with database.AsyncSessionLocal() as db:
+            released = await storage.release_blobs(db, [digest(body)])
+            await db.commit()
+
+            async def fail():
+                raise RuntimeError("commit failed")
+            db.commit = fail
+            try:
+                await storage.collect_blobs(db, released)
+            except RuntimeError:
+                pass
+            await db.rollback()
+
+    asyncio.run(collect_with_failing_commit())
+    assert blob_row(digest(body)).refcount == 0
+    assert stored_files(digest(body)) == files
+
+
+def test_upload_named_like_a_folder_is_refused(client, folder):
+    client.post("/folders/create", json={"name": "Drawings", "parent_id": folder})
+    response = client.post(
+        "/files/upload", files={"file": ("Drawings", b"x", "text/plain")}, data={"parent_id": str(folder)}
+    )
+    assert response.status_code == 409
+    listing = client.get("/files/list", params={"parent_id": folder}).json()
+    assert [(item["name"], item["is_folder"]) for item in listing] == [("Drawings", True)]
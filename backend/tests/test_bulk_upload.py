@@ -0,0 +1,53 @@
+import io
+import os
+import zipfile
+
+import main
+import storage
+
+
+def spool_files():
+    return os.listdir(storage.SPOOL_DIR) if os.path.isdir(storage.SPOOL_DIR) else []
+
+
+def test_bulk_upload_extracts_archives_next_to_plain_files(client, folder):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as archive:
+        archive.writestr("notes/week-1.txt", b"gear trains")
+    response = client.post("/files/upload/bulk", files=[
+        ("files", ("readme.txt", b"read me", "text/plain")),
+        ("files", ("notes.zip", buf.getvalue(), "application/zip")),
+    ], data={"parent_id": str(folder), "extract_archives": "true"})
+
+    assert response.status_code == 200, response.text
+    assert response.json()["files"] == ["readme.txt", "notes/week-1.txt"]
+    assert spool_files() == []
+
+
+def test_bulk_upload_over_content_length_is_refused_unread(client, folder):
+    sent = []
+
+    def body():
+        sent.append(True)
+        yield b"never read"
+
+    response = client.post("/files/upload/bulk", content=body(), headers={
+        "Content-Type": "multipart/form-data; boundary=xx",
+        "Content-Length": str(main.BULK_MAX_TOTAL_SIZE * 2),
+    })
+    assert response.status_code == 413
+    assert sent == []
+
+
+def test_bulk_upload_total_is_capped_while_reading(client, folder, monkeypatch):
+    monkeypatch.setattr(main, "BULK_MAX_TOTAL_SIZE", 100 * 1024)
+    files = [("files", (f"{i}.bin", os.urandom(40 * 1024), "application/octet-stream")) for i in range(3)]
+    # Chunked, so nothing can be refused from a Content-Length up front
+    request = client.build_request("POST", "/files/upload/bulk", files=files, data={"parent_id": str(folder)})
+    request.headers.pop("Content-Length")
+    request.headers["Transfer-Encoding"] = "chunked"
+    response = client.send(request)
+
+    assert response.status_code == 413
+    assert "add up to" in response.json()["detail"]
+    assert spool_files() == []
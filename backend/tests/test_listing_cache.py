@@ -0,0 +1,105 @@
+import hashlib
+
+from conftest import upload
+
+
+def list_folder(client, folder_id, **headers):
+    return client.get("/files/list", params={"parent_id": folder_id}, headers=headers)
+
+
+def names(response):
+    return sorted(item["name"] for item in response.json())
+
+
+def test_listing_revalidates_with_etag(client, folder):
+    first = list_folder(client, folder)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    again = list_folder(client, folder, **{"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag
+
+
+def test_upload_changes_listing_and_etag(client, folder):
+    upload(client, "a.txt", b"a", folder)
+    before = list_folder(client, folder)
+    assert names(before) == ["a.txt"]
+
+    upload(client, "b.txt", b"b", folder)
+    after = list_folder(client, folder, **{"If-None-Match": before.headers["etag"]})
+    assert after.status_code == 200
+    assert after.headers["etag"] != before.headers["etag"]
+    assert names(after) == ["a.txt", "b.txt"]
+
+
+def test_delete_changes_listing_and_etag(client, folder):
+    file_id = upload(client, "gone.txt", b"x", folder)
+    upload(client, "kept.txt", b"y", folder)
+    before = list_folder(client, folder)
+
+    assert client.delete(f"/files/delete/{file_id}").status_code == 200
+    after = list_folder(client, folder, **{"If-None-Match": before.headers["etag"]})
+    assert after.status_code == 200
+    assert names(after) == ["kept.txt"]
+
+
+def test_new_folder_reusing_a_deleted_id_does_not_revalidate(client, folder):
+    old = client.post("/folders/create", json={"name": "old", "parent_id": folder}).json()["id"]
+    upload(client, "old.txt", b"o", old)
+    before = list_folder(client, old)
+
+    assert client.delete(f"/files/delete/{old}").status_code == 200
+    new = client.post("/folders/create", json={"name": "new", "parent_id": folder}).json()["id"]
+    assert new == old  # SQLite hands out the freed id again
+    upload(client, "new.txt", b"n", new)
+    after = list_folder(client, new, **{"If-None-Match": before.headers["etag"]})
+    assert after.status_code == 200
+    assert names(after) == ["new.txt"]
+
+
+def test_change_in_subfolder_leaves_parent_listing_valid(client, folder):
+    sub = client.post("/folders/create", json={"name": "sub", "parent_id": folder}).json()["id"]
+    before = list_folder(client, folder)
+
+    upload(client, "inner.txt", b"z", sub)
+    assert list_folder(client, folder, **{"If-None-Match": before.headers["etag"]}).status_code == 304
+    assert names(list_folder(client, sub)) == ["inner.txt"]
+
+
+def test_download_etag(client, folder):
+    file_id = upload(client, "d.bin", b"\x00\x01" * 100, folder)
+    response = client.get(f"/files/download/{file_id}")
+    assert response.status_code == 200
+    conditional = client.get(f"/files/download/{file_id}", headers={"If-None-Match": response.headers["etag"]})
+    assert conditional.status_code == 304
+    assert conditional.content == b""
+
+
+def list_pages(client, folder_id, sort, order):
+    ids, cursor = [], None
+    while True:
+        params = {"parent_id": folder_id, "sort": sort, "order": order, "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/files/list", params=params)
+        assert response.status_code == 200, response.text
+        ids += [item["id"] for item in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            return ids
+
+
+def test_type_sort_pages_through_files_without_content_type(client, folder):
+    body = b"instant uploads carry no content type"
+    typed = [upload(client, f"typed-{i}.txt", body, folder, "text/plain") for i in range(2)]
+    untyped = [
+        client.post("/files/upload/instant", json={
+            "filename": f"untyped-{i}.bin", "content_hash": hashlib.sha256(body).hexdigest(),
+            "size": len(body), "parent_id": folder,
+        }).json()["id"]
+        for i in range(5)
+    ]
+
+    assert list_pages(client, folder, "type", "asc") == untyped + typed
+    assert list_pages(client, folder, "type", "desc") == typed[::-1] + untyped[::-1]
@@ -0,0 +1,79 @@
+import argparse
+import hashlib
+
+from sqlalchemy import select
+
+import main
+import migrate_blobs
+import models
+from conftest import blob_row, stored_files, upload
+from database import get_engine
+
+
+def add_inline_file(folder_id, name, body, content_type="text/plain"):
+    # A row as uploads stored it before the blob store
+    with main.SessionLocal() as session:
+        row = models.DBFile(
+            filename=name, content_type=content_type, size=len(body), data=body,
+            parent_id=folder_id, is_folder=False
+        )
+        session.add(row)
+        session.commit()
+        return row.id
+
+
+def migrate(**overrides):
+    args = dict(restart=True, limit=None, batch_rows=2, batch_bytes=1024 * 1024, fetch_rows=8, max_rate=0, pause=0)
+    args.update(overrides)
+    migrate_blobs.run(get_engine(), argparse.Namespace(**args))
+
+
+def file_row(file_id):
+    with main.SessionLocal() as session:
+        return session.execute(
+            select(models.DBFile.content_hash, models.DBFile.data).where(models.DBFile.id == file_id)
+        ).one()
+
+
+def test_inline_and_migrated_rows_read_the_same(client, folder):
+    bodies = {f"notes-{i}.txt": f"lecture {i} on gear trains\n".encode() * 200 for i in range(5)}
+    ids = {name: add_inline_file(folder, name, body) for name, body in bodies.items()}
+
+    # Dual read: inline rows are served before the migration
+    for name, file_id in ids.items():
+        assert client.get(f"/files/download/{file_id}").content == bodies[name]
+
+    migrate()
+
+    for name, file_id in ids.items():
+        row = file_row(file_id)
+        assert row.data is None
+        assert row.content_hash == hashlib.sha256(bodies[name]).hexdigest()
+        assert blob_row(row.content_hash).refcount == 1
+        assert client.get(f"/files/download/{file_id}", headers={"Accept-Encoding": "identity"}).content == bodies[name]
+
+
+def test_migration_reuses_uploaded_blobs(client, folder):
+    body = b"shared handout " * 300
+    content_hash = hashlib.sha256(body).hexdigest()
+    upload(client, "uploaded.txt", body, folder, "text/plain")
+    inline_id = add_inline_file(folder, "inline.txt", body)
+
+    migrate()
+
+    assert file_row(inline_id).content_hash == content_hash
+    assert blob_row(content_hash).refcount == 2
+    assert len(stored_files(content_hash)) == 1
+    assert client.get(f"/files/download/{inline_id}", headers={"Accept-Encoding": "identity"}).content == body
+
+
+def test_migrated_blob_is_collected_with_its_last_file(client, folder):
+    body = b"only copy " * 100
+    content_hash = hashlib.sha256(body).hexdigest()
+    file_id = add_inline_file(folder, "single.txt", body)
+    migrate()
+    assert stored_files(content_hash)
+
+    assert client.delete(f"/files/delete/{file_id}").status_code == 200
+    assert blob_row(content_hash) is None
+    assert stored_files(content_hash) == []
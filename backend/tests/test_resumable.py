@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+import resumable
+
+CHUNK_TYPE = {"Content-Type": resumable.CHUNK_MEDIA_TYPE}
+
+
+def create(client, folder_id, body, name="big.bin"):
+    response = client.post("/uploads", json={
+        "filename": name, "length": len(body), "content_type": "application/octet-stream", "parent_id": folder_id
+    })
+    assert response.status_code == 201, response.text
+    return response.json()["id"]
+
+
+def patch(client, upload_id, offset, data):
+    return client.patch(
+        f"/uploads/{upload_id}", content=data, headers={**CHUNK_TYPE, "Upload-Offset": str(offset)}
+    )
+
+
+def offset(client, upload_id):
+    response = client.head(f"/uploads/{upload_id}")
+    assert response.status_code == 200
+    return int(response.headers["upload-offset"])
+
+
+def test_upload_in_pieces_and_finalize(client, folder):
+    body = os.urandom(300 * 1024)
+    upload_id = create(client, folder, body)
+    assert offset(client, upload_id) == 0
+
+    response = patch(client, upload_id, 0, body[:100 * 1024])
+    assert response.status_code == 204
+    assert response.headers["upload-offset"] == str(100 * 1024)
+    assert patch(client, upload_id, 100 * 1024, body[100 * 1024:]).status_code == 204
+    assert offset(client, upload_id) == len(body)
+
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 200, response.text
+    assert client.get(f"/files/download/{response.json()['id']}").content == body
+    # The session is gone with the finalize
+    assert client.head(f"/uploads/{upload_id}").status_code == 404
+    assert not os.path.exists(resumable.part_path(upload_id))
+
+
+def test_resume_from_the_offset_the_server_reports(client, folder):
+    body = os.urandom(64 * 1024)
+    upload_id = create(client, folder, body)
+    patch(client, upload_id, 0, body[:10000])
+
+    # A retry of a piece the server already has is refused with the offset to use
+    response = patch(client, upload_id, 0, body[:20000])
+    assert response.status_code == 409
+    assert response.headers["upload-offset"] == "10000"
+
+    assert patch(client, upload_id, offset(client, upload_id), body[10000:]).status_code == 204
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert client.get(f"/files/download/{response.json()['id']}").content == body
+
+
+def test_finalize_before_everything_arrived(client, folder):
+    body = b"x" * 5000
+    upload_id = create(client, folder, body)
+    patch(client, upload_id, 0, body[:1000])
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 409
+    assert response.headers["upload-offset"] == "1000"
+
+
+def test_finalize_checks_the_part_on_disk(client, folder):
+    body = os.urandom(8000)
+    upload_id = create(client, folder, body)
+    patch(client, upload_id, 0, body)
+    # Data lost after the offset was recorded, e.g. a disk restored from backup
+    with open(resumable.part_path(upload_id), "r+b") as f:
+        f.truncate(5000)
+
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 409
+    assert response.headers["upload-offset"] == "5000"
+    assert offset(client, upload_id) == 5000
+
+    assert patch(client, upload_id, 5000, body[5000:]).status_code == 204
+    response = client.post(f"/uploads/{upload_id}/finalize")
+    assert response.status_code == 200
+    assert client.get(f"/files/download/{response.json()['id']}").content == body
+
+
+def test_finalize_without_part_file(client, folder):
+    body = b"y" * 100
+    upload_id = create(client, folder, body)
+    patch(client, upload_id, 0, body)
+    os.remove(resumable.part_path(upload_id))
+    assert client.post(f"/uploads/{upload_id}/finalize").status_code == 410
+
+
+def test_more_than_declared_is_refused(client, folder):
+    upload_id = create(client, folder, b"z" * 100)
+    assert patch(client, upload_id, 0, b"z" * 150).status_code == 413
+    assert offset(client, upload_id) == 0
+
+
+def test_part_locked_by_another_writer(client, folder):
+    fcntl = pytest.importorskip("fcntl")
+    body = b"w" * 100
+    upload_id = create(client, folder, body)
+    # As if a request in another worker process were writing to it
+    with open(resumable.part_path(upload_id), "r+b") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        assert patch(client, upload_id, 0, body).status_code == 409
+    assert patch(client, upload_id, 0, body).status_code == 204
+
+
+def test_chunks_need_their_media_type(client, folder):
+    upload_id = create(client, folder, b"v" * 10)
+    response = client.patch(
+        f"/uploads/{upload_id}", content=b"v" * 10,
+        headers={"Content-Type": "application/octet-stream", "Upload-Offset": "0"}
+    )
+    assert response.status_code == 415
+
+
+def test_cancel_removes_session_and_data(client, folder):
+    upload_id = create(client, folder, b"u" * 10)
+    assert client.delete(f"/uploads/{upload_id}").status_code == 204
+    assert client.head(f"/uploads/{upload_id}").status_code == 404
+    assert not os.path.exists(resumable.part_path(upload_id))
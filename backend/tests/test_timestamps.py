@@ -0,0 +1,24 @@
+from sqlalchemy import DateTime, insert
+from sqlalchemy.dialects.postgresql import asyncpg
+
+import migrations
+import models
+from database import Base
+
+
+def test_timestamps_bind_with_time_zone_through_asyncpg():
+    # asyncpg types every parameter from the cast SQLAlchemy renders, an aware
+    # utcnow() bound as TIMESTAMP WITHOUT TIME ZONE fails on Postgres
+    dialect = asyncpg.dialect()
+    assert models.utcnow().tzinfo is not None
+    checked = 0
+    for table in [*Base.metadata.sorted_tables, migrations.schema_migrations]:
+        for column in table.columns:
+            if not isinstance(column.type, DateTime):
+                continue
+            stmt = insert(table).values({column.name: models.utcnow()})
+            sql = str(stmt.compile(dialect=dialect))
+            assert "TIMESTAMP WITH TIME ZONE" in sql, f"{table.name}.{column.name}: {sql}"
+            assert "WITHOUT TIME ZONE" not in sql, f"{table.name}.{column.name}: {sql}"
+            checked += 1
+    assert checked == 9
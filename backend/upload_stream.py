@@ -0,0 +1,253 @@
+import hashlib
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+# Same parser and import fallback as Starlette's form parsing
+try:
+    try:
+        import python_multipart as multipart
+        from python_multipart.exceptions import FormParserError
+        from python_multipart.multipart import parse_options_header
+    except ModuleNotFoundError:
+        import multipart
+        from multipart.exceptions import FormParserError
+        from multipart.multipart import parse_options_header
+except ModuleNotFoundError:
+    multipart = None
+    parse_options_header = None
+
+import storage
+
+# Uploads (POST /files/upload and /files/upload/bulk) parsed while the body
+# arrives. Every file part goes straight to the blob spool, hashed on the way,
+# instead of to Starlette's temporary file first and then copied. A body over
+# the limits is refused from Content-Length before anything is read, or as
+# soon as a file part grows past them
+
+# Boundaries, part headers and the small fields next to the files
+FORM_OVERHEAD = 64 * 1024
+# Boundary and headers of each file part
+PART_OVERHEAD = 1024
+MAX_FIELD_SIZE = 64 * 1024
+MAX_FIELDS = 16
+
+
+class InvalidForm(Exception):
+    pass
+
+
+@dataclass
+class UploadedFile:
+    filename: str
+    content_type: Optional[str]
+    spool_path: str
+    size: int = 0
+    content_hash: Optional[str] = None
+
+
+@dataclass
+class UploadForm:
+    fields: dict = field(default_factory=dict)
+    files: list = field(default_factory=list)  # UploadedFile, in body order
+
+
+def _decode(value):
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+
+def discard_files(files):
+    for uploaded in files:
+        storage.discard_spool(uploaded.spool_path)
+
+
+class _Spool:
+    """A file part on its way to the spool. Opened on its first flush, so only
+    the part being read holds a descriptor."""
+
+    def __init__(self, uploaded):
+        self.uploaded = uploaded
+        self.digest = hashlib.sha256()
+        self.out = None
+        self.pending = bytearray()
+        self.ended = False
+
+    def flush(self):
+        if self.out is None:
+            self.out = open(self.uploaded.spool_path, "wb")
+        if self.pending:
+            data = bytes(self.pending)
+            self.pending.clear()
+            self.digest.update(data)
+            self.out.write(data)
+        if self.ended:
+            self.out.flush()
+            os.fsync(self.out.fileno())
+            self.out.close()
+            self.uploaded.content_hash = self.digest.hexdigest()
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+
+
+class _FormReader:
+    """Callbacks for python-multipart, file data is buffered until flushed to the spool."""
+
+    def __init__(self, file_field, max_size, max_files, max_total):
+        self.file_field = file_field
+        self.max_size = max_size
+        self.max_files = max_files
+        self.max_total = max_total
+        self.form = UploadForm()
+        self.total = 0
+        self.pending_size = 0
+        self._spools = []
+        self._unflushed = []  # Spools with buffered data, or ended and still open
+        self._headers = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._name = None
+        self._data = None  # Field value being read, None inside a file part
+        self._spool = None  # File part being read
+        self.ended = False
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._name = None
+
+    def on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise InvalidForm('The Content-Disposition header field "name" must be provided')
+        self._name = _decode(options[b"name"])
+        if b"filename" in options:
+            if self._name != self.file_field:
+                raise InvalidForm(f"Files go in the {self.file_field} field")
+            if len(self._spools) >= self.max_files:
+                raise InvalidForm(f"More than {self.max_files} files in one upload")
+            content_type = self._headers.get(b"content-type")
+            uploaded = UploadedFile(
+                _decode(options[b"filename"]), _decode(content_type) if content_type else None,
+                storage.new_spool_path()
+            )
+            self.form.files.append(uploaded)
+            self._spool = _Spool(uploaded)
+            self._spools.append(self._spool)
+            self._unflushed.append(self._spool)
+            self._data = None
+        else:
+            if len(self.form.fields) >= MAX_FIELDS:
+                raise InvalidForm(f"More than {MAX_FIELDS} fields")
+            self._data = bytearray()
+
+    def on_part_data(self, data, start, end):
+        if self._spool is not None:
+            size = end - start
+            self._spool.uploaded.size += size
+            if self._spool.uploaded.size > self.max_size:
+                raise storage.UploadTooLarge(f"File exceeds the {self.max_size} byte limit")
+            self.total += size
+            if self.max_total is not None and self.total > self.max_total:
+                raise storage.UploadTooLarge(f"Files add up to more than the {self.max_total} byte limit")
+            self._spool.pending += data[start:end]
+            self.pending_size += size
+        else:
+            self._data += data[start:end]
+            if len(self._data) > MAX_FIELD_SIZE:
+                raise InvalidForm(f"Field {self._name} is too large")
+
+    def on_part_end(self):
+        if self._spool is not None:
+            self._spool.ended = True
+            self._spool = None
+        else:
+            self.form.fields[self._name] = _decode(bytes(self._data))
+
+    def on_end(self):
+        self.ended = True
+
+    def needs_flush(self):
+        # Enough buffered, or a finished part to close
+        return self.pending_size >= storage.UPLOAD_CHUNK_SIZE or (
+            len(self._unflushed) > 1 or (self._unflushed and self._unflushed[0].ended)
+        )
+
+    def flush(self):
+        # Blocking, run it off the event loop
+        for spool in self._unflushed:
+            spool.flush()
+        self._unflushed = [spool for spool in self._unflushed if not spool.ended]
+        self.pending_size = 0
+
+    def discard(self):
+        for spool in self._spools:
+            spool.close()
+        discard_files(self.form.files)
+
+
+async def read_upload_form(request, max_size=storage.MAX_UPLOAD_SIZE, file_field="file", max_files=1, max_total=None):
+    """Parse a multipart/form-data body, spooling its files as they arrive.
+
+    Up to max_files files, all in file_field, each up to max_size bytes and
+    together up to max_total. Returns an UploadForm, files is empty when the
+    body had none. Raises storage.UploadTooLarge, InvalidForm and
+    ClientDisconnect; the spools are discarded on any error.
+    """
+    if multipart is None:
+        raise RuntimeError("The python-multipart package is needed to parse uploads")
+    max_body = max_size * max_files if max_total is None else min(max_total, max_size * max_files)
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and (
+        int(content_length) > max_body + FORM_OVERHEAD + PART_OVERHEAD * max_files
+    ):
+        if max_files == 1:
+            raise storage.UploadTooLarge(f"File exceeds the {max_size} byte limit")
+        raise storage.UploadTooLarge(f"Files add up to more than the {max_body} byte limit")
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise InvalidForm("Expected a multipart/form-data body")
+
+    reader = _FormReader(file_field, max_size, max_files, max_total)
+    parser = multipart.MultipartParser(params[b"boundary"], {
+        "on_part_begin": reader.on_part_begin,
+        "on_part_data": reader.on_part_data,
+        "on_part_end": reader.on_part_end,
+        "on_header_field": reader.on_header_field,
+        "on_header_value": reader.on_header_value,
+        "on_header_end": reader.on_header_end,
+        "on_headers_finished": reader.on_headers_finished,
+        "on_end": reader.on_end,
+    })
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except FormParserError as e:
+                raise InvalidForm(str(e))
+            if reader.needs_flush():
+                await run_in_threadpool(reader.flush)
+        parser.finalize()
+        if not reader.ended:
+            raise InvalidForm("The multipart body ends before its closing boundary")
+        await run_in_threadpool(reader.flush)
+    except BaseException:
+        await run_in_threadpool(reader.discard)
+        raise
+    return reader.form
@@ -0,0 +1,31 @@
+import axios from 'axios';
+
+// Smaller files are sent right away, hashing them would not save anything
+export const INSTANT_MIN_SIZE = 256 * 1024;
+// SubtleCrypto only hashes a whole buffer, the file has to fit in the tab's
+// memory. Bigger files go through resumable uploads without the handshake
+export const INSTANT_MAX_SIZE = 16 * 1024 * 1024;
+
+async function sha256Hex(file) {
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Links the file to content the server already holds, returns false when
+// the body has to be uploaded after all
+export async function tryInstantUpload(api, file, parentId) {
+  // SubtleCrypto exists in secure contexts (https, localhost) only
+  if (file.size < INSTANT_MIN_SIZE || file.size > INSTANT_MAX_SIZE || !window.crypto?.subtle) return false;
+  try {
+    const { data } = await axios.post(`${api}/files/upload/instant`, {
+      filename: file.name,
+      content_hash: await sha256Hex(file),
+      size: file.size,
+      content_type: file.type || null,
+      parent_id: parentId ?? null,
+    });
+    return data.instant;
+  } catch (error) {
+    return false;
+  }
+}
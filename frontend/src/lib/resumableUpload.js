@@ -0,0 +1,56 @@
+import axios from 'axios';
+
+// Files at least this big go through resumable uploads, see backend/resumable.py
+export const RESUMABLE_THRESHOLD = 16 * 1024 * 1024;
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const MAX_RETRIES = 5;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// After a failed chunk, ask the server how much it kept and go on from there
+async function currentOffset(api, uploadId) {
+  const response = await axios.head(`${api}/uploads/${uploadId}`);
+  return Number(response.headers['upload-offset']);
+}
+
+export async function uploadResumable(api, file, parentId, onProgress) {
+  const { data: session } = await axios.post(`${api}/uploads`, {
+    filename: file.name,
+    length: file.size,
+    content_type: file.type || null,
+    parent_id: parentId ?? null,
+  });
+
+  let offset = 0;
+  let failures = 0;
+  while (offset < file.size) {
+    try {
+      const response = await axios.patch(
+        `${api}/uploads/${session.id}`,
+        file.slice(offset, offset + CHUNK_SIZE),
+        {
+          headers: {
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Offset': String(offset),
+          },
+        }
+      );
+      offset = Number(response.headers['upload-offset']);
+      failures = 0;
+    } catch (error) {
+      const code = error.response?.status;
+      if (code && code !== 409 && code < 500) throw error;
+      if (++failures > MAX_RETRIES) throw error;
+      await sleep(1000 * 2 ** (failures - 1));
+      try {
+        offset = await currentOffset(api, session.id);
+      } catch (headError) {
+        // Still offline, the next attempt starts from the old offset
+      }
+    }
+    if (onProgress) onProgress(offset / file.size);
+  }
+
+  const { data } = await axios.post(`${api}/uploads/${session.id}/finalize`);
+  return data;
+}
@@ -3,6 +3,7 @@ import { toast } from 'sonner';
 import { Link } from 'react-router-dom';
 import axios from 'axios';
 import { API } from '../App';
+import { formatSize } from '../lib/utils';
 
 function StudentFiles() {
   const [items, setItems] = useState([]);
@@ -13,9 +14,18 @@ function StudentFiles() {
   const fetchFiles = async (folderId = currentFolder?.id) => {
     try {
       setLoading(true);
-      const params = folderId ? { parent_id: folderId } : {};
-      const response = await axios.get(`${API}/files/list`, { params });
-      setItems(response.data);
+      const params = folderId ? { parent_id: folderId, sizes: 'raw' } : { sizes: 'raw' };
+      // The listing is paginated, follow the cursor until the last page
+      let allItems = [];
+      let cursor = null;
+      do {
+        const response = await axios.get(`${API}/files/list`, {
+          params: cursor ? { ...params, cursor } : params,
+        });
+        allItems = allItems.concat(response.data);
+        cursor = response.headers['x-next-cursor'];
+      } while (cursor);
+      setItems(allItems);
     } catch (error) {
       toast.error("Failed to fetch files.");
     } finally {
@@ -80,6 +90,26 @@ function StudentFiles() {
     return <svg className={`${iconClass} text-blue-400`} fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M9 12h6m-6 4h6m2 5H7a2 2 0 01-2-2V5a2 2 0 012-2h5.586a1 1 0 01.707.293l5.414 5.414a1 1 0 01.293.707V19a2 2 0 01-2 2z" /></svg>;
   };
 
+  const FilePreview = ({ item }) => {
+    const previewable = !item.is_folder && item.type && (item.type.startsWith('image/') || item.type === 'application/pdf');
+    if (!previewable) {
+      return <FileIcon type={item.type} isFolder={item.is_folder} />;
+    }
+    // Thumbnail from the server, the generic icon when it has none
+    return (
+      <>
+        <img
+          src={`${API}/files/${item.id}/preview?w=64`}
+          alt=""
+          loading="lazy"
+          className="w-8 h-8 mr-4 flex-shrink-0 rounded object-cover"
+          onError={(e) => { e.currentTarget.style.display = 'none'; e.currentTarget.nextElementSibling.style.display = ''; }}
+        />
+        <span style={{ display: 'none' }}><FileIcon type={item.type} isFolder={false} /></span>
+      </>
+    );
+  };
+
   return (
     <div className="min-h-screen bg-gradient-to-br from-[#0a0a0b] via-[#111113] to-[#0a0a0b] text-white p-4 sm:p-8">
       <div className="container mx-auto max-w-5xl">
@@ -156,7 +186,7 @@ function StudentFiles() {
                   className="group relative p-4 bg-white/5 border border-white/5 hover:border-cyan-500/50 hover:bg-white/10 rounded-lg cursor-pointer transition-all hover:-translate-y-1"
                 >
                   <div className="flex items-start justify-between mb-3">
-                    <FileIcon type={item.type} isFolder={item.is_folder} />
+                    <FilePreview item={item} />
                     <button
                       onClick={(e) => { e.stopPropagation(); handleDownload(item); }}
                       className="text-gray-600 hover:text-cyan-400 p-1 opacity-0 group-hover:opacity-100 transition"
@@ -167,7 +197,7 @@ function StudentFiles() {
                   </div>
                   <div>
                     <h3 className="font-medium text-gray-200 truncate pr-4">{item.name}</h3>
-                    <p className="text-xs text-gray-500 mt-1">{item.size}</p>
+                    <p className="text-xs text-gray-500 mt-1">{formatSize(item.size)}</p>
                   </div>
                 </div>
               ))}
@@ -3,6 +3,9 @@ import { toast } from 'sonner';
 import { Link } from 'react-router-dom';
 import axios from 'axios';
 import { API } from '../App';
+import { formatSize } from '../lib/utils';
+import { RESUMABLE_THRESHOLD, uploadResumable } from '../lib/resumableUpload';
+import { tryInstantUpload } from '../lib/instantUpload';
 
 function TeacherFiles() {
   const [items, setItems] = useState([]);
@@ -13,9 +16,18 @@ function TeacherFiles() {
   const fetchFiles = async (folderId = currentFolder?.id) => {
     try {
       setLoading(true);
-      const params = folderId ? { parent_id: folderId } : {};
-      const response = await axios.get(`${API}/files/list`, { params });
-      setItems(response.data);
+      const params = folderId ? { parent_id: folderId, sizes: 'raw' } : { sizes: 'raw' };
+      // The listing is paginated, follow the cursor until the last page
+      let allItems = [];
+      let cursor = null;
+      do {
+        const response = await axios.get(`${API}/files/list`, {
+          params: cursor ? { ...params, cursor } : params,
+        });
+        allItems = allItems.concat(response.data);
+        cursor = response.headers['x-next-cursor'];
+      } while (cursor);
+      setItems(allItems);
     } catch (error) {
       toast.error("Failed to fetch files.");
     } finally {
@@ -50,20 +62,41 @@ function TeacherFiles() {
   };
 
   const handleFileUpload = async (event) => {
-    const file = event.target.files[0];
-    if (file) {
-      const formData = new FormData();
-      formData.append('file', file);
-      if (currentFolder) {
-        formData.append('parent_id', currentFolder.id);
-      }
-
+    const files = Array.from(event.target.files);
+    if (files.length) {
       try {
-        await axios.post(`${API}/files/upload`, formData);
-        toast.success(`File "${file.name}" uploaded.`);
+        // Content the server already has is linked without sending it again
+        const pending = [];
+        for (const file of files) {
+          if (!(await tryInstantUpload(API, file, currentFolder?.id))) pending.push(file);
+        }
+        // Large files go up resumably, one by one, all others in one request
+        const large = pending.filter((file) => file.size >= RESUMABLE_THRESHOLD);
+        const small = pending.filter((file) => file.size < RESUMABLE_THRESHOLD);
+
+        for (const file of large) {
+          const toastId = toast.loading(`Uploading "${file.name}"...`);
+          try {
+            await uploadResumable(API, file, currentFolder?.id, (progress) => {
+              toast.loading(`Uploading "${file.name}"... ${Math.round(progress * 100)}%`, { id: toastId });
+            });
+          } finally {
+            toast.dismiss(toastId);
+          }
+        }
+        if (small.length) {
+          const formData = new FormData();
+          small.forEach((file) => formData.append('files', file));
+          if (currentFolder) {
+            formData.append('parent_id', currentFolder.id);
+          }
+          await axios.post(`${API}/files/upload/bulk`, formData);
+        }
+        toast.success(files.length === 1 ? `File "${files[0].name}" uploaded.` : `${files.length} files uploaded.`);
         fetchFiles();
       } catch (error) {
         toast.error(error.response?.data?.detail || 'File upload failed.');
+        fetchFiles();
       }
       event.target.value = null; // Reset input
     }
@@ -146,6 +179,26 @@ function TeacherFiles() {
     return <svg className={`${iconClass} text-blue-400`} fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M9 12h6m-6 4h6m2 5H7a2 2 0 01-2-2V5a2 2 0 012-2h5.586a1 1 0 01.707.293l5.414 5.414a1 1 0 01.293.707V19a2 2 0 01-2 2z" /></svg>;
   };
 
+  const FilePreview = ({ item }) => {
+    const previewable = !item.is_folder && item.type && (item.type.startsWith('image/') || item.type === 'application/pdf');
+    if (!previewable) {
+      return <FileIcon type={item.type} isFolder={item.is_folder} />;
+    }
+    // Thumbnail from the server, the generic icon when it has none
+    return (
+      <>
+        <img
+          src={`${API}/files/${item.id}/preview?w=64`}
+          alt=""
+          loading="lazy"
+          className="w-8 h-8 mr-4 flex-shrink-0 rounded object-cover"
+          onError={(e) => { e.currentTarget.style.display = 'none'; e.currentTarget.nextElementSibling.style.display = ''; }}
+        />
+        <span style={{ display: 'none' }}><FileIcon type={item.type} isFolder={false} /></span>
+      </>
+    );
+  };
+
   return (
     <div className="min-h-screen bg-gradient-to-br from-[#0a0a0b] via-[#111113] to-[#0a0a0b] text-white p-4 sm:p-8">
       <div className="container mx-auto max-w-5xl">
@@ -225,7 +278,7 @@ function TeacherFiles() {
             <label className="cursor-pointer px-4 py-2 bg-cyan-600 hover:bg-cyan-500 rounded-lg text-sm font-medium transition flex items-center">
               <svg className="w-5 h-5 mr-2" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M4 16v1a3 3 0 003 3h10a3 3 0 003-3v-1m-4-8l-4-4m0 0L8 8m4-4v12" /></svg>
               Upload File
-              <input type="file" className="hidden" onChange={handleFileUpload} accept=".pdf,.doc,.docx,.jpg,.png" />
+              <input type="file" className="hidden" multiple onChange={handleFileUpload} accept=".pdf,.doc,.docx,.jpg,.png" />
             </label>
           </div>
         </div>
@@ -259,7 +312,7 @@ function TeacherFiles() {
                   className="group relative p-4 bg-white/5 border border-white/5 hover:border-cyan-500/50 hover:bg-white/10 rounded-lg cursor-pointer transition-all hover:-translate-y-1"
                 >
                   <div className="flex items-start justify-between mb-3">
-                    <FileIcon type={item.type} isFolder={item.is_folder} />
+                    <FilePreview item={item} />
                     <button
                       onClick={(e) => { e.stopPropagation(); handleDelete(item); }}
                       className="text-gray-600 hover:text-red-400 p-1 opacity-0 group-hover:opacity-100 transition"
@@ -270,7 +323,7 @@ function TeacherFiles() {
                   </div>
                   <div>
                     <h3 className="font-medium text-gray-200 truncate pr-4">{item.name}</h3>
-                    <p className="text-xs text-gray-500 mt-1">{item.size}</p>
+                    <p className="text-xs text-gray-500 mt-1">{formatSize(item.size)}</p>
                   </div>
                 </div>
               ))}